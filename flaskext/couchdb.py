@@ -12,9 +12,24 @@ server easier.
 # needed to properly import the main CouchDB module
 # wish they would have required absolute imports from the start
 from __future__ import absolute_import
+from __future__ import with_statement
 import couchdb
 import couchdb.mapping as mapping
+import collections
+import functools
+import hashlib
+import Queue
 import itertools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+import urlparse
+import weakref
+from couchdb import http
 from couchdb.client import Row, ViewResults
 from couchdb.design import ViewDefinition as OldViewDefinition
 # easier than manually assigning them
@@ -22,12 +37,807 @@ from couchdb.mapping import (Field, TextField, FloatField, IntegerField,
                              LongField, BooleanField, DecimalField, DateField,
                              DateTimeField, TimeField, DictField, ListField,
                              Mapping, DEFAULT)
-from flask import g, current_app, json, abort
+from flask import g, current_app, request, json, abort, Response
+from werkzeug.local import LocalProxy
 
-__all__ = ['CouchDBManager', 'ViewDefinition', 'Row', 'paginate']
+__all__ = ['CouchDBManager', 'ViewDefinition', 'Row', 'paginate',
+           'ConnectionPoolTimeout', 'DocumentCache', 'ViewCache',
+           'ChangesListener', 'stream_view', 'AsyncResult', 'call_async',
+           'gather', 'paginate_numbered', 'ViewWarmer', 'ViewRefresher',
+           'RequestStats', 'CallRecord']
 __all__.extend(mapping.__all__)
 
 
+### Connection pooling and caching
+
+class ConnectionPoolTimeout(Exception):
+    """
+    This is raised when all the connections in the pool are busy and none of
+    them were released within the `COUCHDB_POOL_TIMEOUT`.
+    """
+
+
+class _BoundedConnectionPool(http.ConnectionPool):
+    """
+    This is a `couchdb.http.ConnectionPool` that never has more than `size`
+    connections checked out at once. If the pool is exhausted, threads wait
+    for a connection to be released for up to `wait_timeout` seconds (or
+    forever, if it is `None`).
+    """
+    def __init__(self, size, wait_timeout=None, timeout=None):
+        http.ConnectionPool.__init__(self, timeout)
+        self.size = size
+        self.wait_timeout = wait_timeout
+        self._available = threading.Condition(threading.Lock())
+        self._pending = 0
+        self._in_use = weakref.WeakKeyDictionary()
+    
+    def _busy(self):
+        # connections that were closed (or thrown away) without being
+        # released, like the ones used for continuous feeds, don't count
+        live = [c for c in self._in_use.keys() if c.sock is not None]
+        return self._pending + len(live)
+    
+    def get(self, url):
+        with self._available:
+            if self.wait_timeout is not None:
+                deadline = time.time() + self.wait_timeout
+            while self._busy() >= self.size:
+                if self.wait_timeout is None:
+                    self._available.wait(1.0)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ConnectionPoolTimeout(
+                            'no connection available after %s seconds' %
+                            self.wait_timeout
+                        )
+                    self._available.wait(min(remaining, 1.0))
+            self._pending += 1
+        try:
+            conn = http.ConnectionPool.get(self, url)
+        finally:
+            with self._available:
+                self._pending -= 1
+        with self._available:
+            self._in_use[conn] = True
+        return conn
+    
+    def release(self, url, conn):
+        with self._available:
+            self._in_use.pop(conn, None)
+            self._available.notify()
+        if conn.sock is not None:
+            http.ConnectionPool.release(self, url, conn)
+
+
+class DocumentCache(http.Cache):
+    """
+    This is a process-wide LRU cache of response bodies, bounded both in the
+    number of entries and in their total size. If it is enabled (see
+    `CouchDBManager.connect_db`), couchdb-python uses it for every GET it
+    makes: a cached response is revalidated with ``If-None-Match``, so if the
+    document hasn't changed, CouchDB answers with an empty ``304`` instead of
+    sending the whole body again.
+    
+    :param max_entries: The maximum number of responses to keep.
+    :param max_bytes: The maximum total size of the cached bodies.
+    """
+    def __init__(self, max_entries=1000, max_bytes=10 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.by_url = collections.OrderedDict()
+        self.size = 0
+        #: The number of `Document.load` calls answered from the cache.
+        self.hits = 0
+        #: The number of `Document.load` calls that had to fetch the body.
+        self.misses = 0
+        #: The `ChangesListener` keeping this cache up to date, if there is
+        #: one. While it is connected, documents loaded through the cache
+        #: are used without revalidating them.
+        self.listener = None
+        self.trusted = set()
+        self.generation = 0
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.by_url)
+    
+    def get(self, url):
+        with self._lock:
+            response = self.by_url.pop(url, None)
+            if response is not None:
+                self.by_url[url] = response
+            return response
+    
+    def put(self, url, response):
+        data = response[2]
+        if not isinstance(data, str) or len(data) > self.max_bytes:
+            self.remove(url)
+            return
+        with self._lock:
+            self._remove(url)
+            self.by_url[url] = response
+            self.size += len(data)
+            while (len(self.by_url) > self.max_entries or
+                   self.size > self.max_bytes):
+                self._remove(next(iter(self.by_url)))
+    
+    def remove(self, url):
+        with self._lock:
+            self._remove(url)
+    
+    def _remove(self, url):
+        old = self.by_url.pop(url, None)
+        if old is not None:
+            self.size -= len(old[2])
+        self.trusted.discard(url)
+    
+    def invalidate(self, url):
+        """
+        This removes the response for the given URL because it is known to
+        have changed. Responses that were being fetched at the same time
+        won't be trusted.
+        
+        :param url: The URL to remove.
+        """
+        with self._lock:
+            self.generation += 1
+            self._remove(url)
+    
+    def clear(self):
+        """
+        This removes every cached response.
+        """
+        with self._lock:
+            self.generation += 1
+            self.by_url.clear()
+            self.trusted.clear()
+            self.size = 0
+    
+    def load(self, db, id):
+        """
+        This fetches the document with the given ID from `db` and returns it
+        (as a `couchdb.client.Document`), or `None` if it doesn't exist. Big
+        documents, which couchdb-python streams instead of caching, are
+        cached too.
+        
+        :param db: The database to fetch the document from.
+        :param id: The document ID.
+        """
+        resource = _document_resource(db, id)
+        url = resource.url
+        generation = self.generation
+        cached = self.get(url)
+        if (cached is not None and url in self.trusted and
+                self.listener is not None and self.listener.connected):
+            self.hits += 1
+            data = cached[2]
+        else:
+            try:
+                status, msg, body = resource.get()
+            except http.ResourceNotFound:
+                return None
+            if cached is not None and msg is cached[1]:
+                self.hits += 1
+                data = cached[2]
+            else:
+                self.misses += 1
+                data = body.read()
+                if 'etag' in msg:
+                    self.put(url, (status, msg, data))
+            with self._lock:
+                if self.generation == generation and url in self.by_url:
+                    self.trusted.add(url)
+        return couchdb.Document(couchdb.json.decode(data.decode('utf-8')))
+
+
+class ChangesListener(threading.Thread):
+    """
+    This follows a database's ``_changes`` feed (using long polling) in a
+    background thread, and calls `callback` with a list of the IDs of the
+    documents that changed. If the connection is lost, it keeps retrying,
+    and resumes from the last sequence it saw once it gets through.
+    
+    When it connects, `callback` is called with `None`, which means that
+    anything could have changed.
+    
+    :param db: The database to follow.
+    :param callback: The function to call with the changed IDs.
+    :param timeout: How many seconds a single poll should wait for changes.
+    :param retry_delay: How many seconds to wait before reconnecting.
+    """
+    def __init__(self, db, callback, timeout=60, retry_delay=5):
+        threading.Thread.__init__(self, name='couchdb-changes-%s' % db.name)
+        self.daemon = True
+        self.db = db
+        self.callback = callback
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        #: The last sequence the listener has seen.
+        self.since = 'now'
+        #: Whether the listener is currently following the feed.
+        self.connected = False
+        #: The process the listener was started in.
+        self.pid = os.getpid()
+        self._stopped = threading.Event()
+    
+    def stop(self):
+        """
+        This stops the listener after its current poll.
+        """
+        self.connected = False
+        self._stopped.set()
+    
+    def run(self):
+        # nobody is waiting on the long polls, so they aren't slow queries
+        _stats_state.background = True
+        try:
+            while not self._stopped.is_set():
+                try:
+                    changes = self.db.changes(feed='longpoll',
+                                              since=self.since,
+                                              timeout=self.timeout * 1000)
+                except Exception:
+                    self.connected = False
+                    self._stopped.wait(self.retry_delay)
+                    continue
+                if self._stopped.is_set():
+                    break
+                if not self.connected:
+                    self.callback(None)
+                    self.connected = True
+                ids = [change['id'] for change in changes['results']]
+                if ids:
+                    self.callback(ids)
+                self.since = changes['last_seq']
+        finally:
+            # if this thread stops for any reason, nobody should rely on it
+            self.connected = False
+
+
+### Warming up views
+
+class _DesignDocCollector(object):
+    """
+    This stands in for the database when it is passed to `sync_many`, so
+    the changed design documents are collected instead of saved.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.docs = []
+    
+    def get(self, id, default=None):
+        return self.db.get(id, default)
+    
+    def update(self, docs):
+        self.docs.extend(docs)
+        return []
+
+
+class ViewWarmer(threading.Thread):
+    """
+    This puts new versions of design documents in place in a background
+    thread, without making anyone wait for their views to be indexed. Each
+    of them is first saved under a staging ID (the design document's ID with
+    `suffix` on the end), and one of its views is queried to start the
+    indexer. Once the ``_info`` of the staging design document says the
+    indexer is done, the real design document is updated. CouchDB shares
+    indexes between design documents with the same views, so the new views
+    can be used right away. Then the staging design document is deleted.
+    
+    Design documents that don't exist yet are saved right away, since
+    nothing can be using them, and then indexed the same way.
+    
+    :param db: The database to update.
+    :param docs: The new versions of the design documents.
+    :param poll_interval: How many seconds to wait between checks of
+                          ``_info``.
+    :param callback: If given, this is called with no arguments once every
+                     design document has been put in place.
+    """
+    #: This is added to a design document's ID to get its staging ID.
+    suffix = '-new'
+    
+    def __init__(self, db, docs, poll_interval=5, callback=None):
+        threading.Thread.__init__(self, name='couchdb-warmer-%s' % db.name)
+        self.daemon = True
+        self.db = db
+        self.docs = docs
+        self.poll_interval = poll_interval
+        self.callback = callback
+        #: The IDs of the design documents that have been put in place.
+        self.deployed = []
+        #: The exception that stopped the warmer, if there was one.
+        self.error = None
+    
+    def run(self):
+        # nobody is waiting on the indexing, so it isn't a slow query
+        _stats_state.background = True
+        try:
+            # everything is staged first, so the indexes are built at once
+            staged = [self._stage(doc) for doc in self.docs]
+            for doc, staging in zip(self.docs, staged):
+                self._wait(staging)
+                if staging['_id'] != doc['_id']:
+                    self.db.save(doc)
+                    self.db.delete(staging)
+                self.deployed.append(doc['_id'])
+            if self.callback is not None:
+                self.callback()
+        except Exception:
+            self.error = sys.exc_info()[1]
+    
+    def _stage(self, doc):
+        if '_rev' not in doc:
+            self.db.save(doc)
+            return doc
+        # only the parts the index depends on are copied, so attachments
+        # and the like stay on the real design document
+        staging = dict((name, doc[name]) for name in
+                       ('language', 'views', 'options') if name in doc)
+        staging['_id'] = doc['_id'] + self.suffix
+        existing = self.db.get(staging['_id'])
+        if existing is not None:
+            staging['_rev'] = existing.rev
+        self.db.save(staging)
+        return staging
+    
+    def _wait(self, doc):
+        views = [name for name in doc.get('views', ()) if name != 'lib']
+        if not views:
+            return
+        design = doc['_id'][len('_design/'):]
+        view = '%s/%s' % (design, views[0])
+        # this starts the indexer without waiting for it
+        self.db.view(view, limit=0, stale='update_after').rows
+        while self.db.info(design)['view_index'].get('updater_running'):
+            time.sleep(self.poll_interval)
+        # if the indexer hadn't started yet, or there have been more changes
+        # since, this waits for the rest
+        self.db.view(view, limit=0).rows
+
+
+class ViewRefresher(threading.Thread):
+    """
+    This keeps the indexes of a database's views up to date in a background
+    thread, so they can be read with ``stale=ok`` (see the ``stale_views``
+    option to `CouchDBManager`) without the results ever getting very old.
+    Every `interval` seconds, it queries one view from each design document
+    without asking for any rows, which updates the index for all of them.
+    
+    :param db: The database to refresh the views in.
+    :param viewdefs: A function that returns the view definitions to keep up
+                     to date.
+    :param interval: How many seconds to wait between refreshes.
+    """
+    def __init__(self, db, viewdefs, interval=10):
+        threading.Thread.__init__(self, name='couchdb-refresher-%s' % db.name)
+        self.daemon = True
+        self.db = db
+        self.viewdefs = viewdefs
+        self.interval = interval
+        #: When each design document's index was last brought up to date
+        #: (as a timestamp), by the name of the design document.
+        self.refreshed = {}
+        #: The exception from the last refresh, if it failed.
+        self.error = None
+        #: The process the refresher was started in.
+        self.pid = os.getpid()
+        self._stopped = threading.Event()
+    
+    def stop(self):
+        """
+        This stops the refresher after its current refresh.
+        """
+        self._stopped.set()
+    
+    def staleness(self, design=None):
+        """
+        This returns the number of seconds since the index of the given design
+        document was last up to date, which is how far behind the database a
+        ``stale=ok`` read can be at most. Without a design document, it is the
+        largest of them. If a view hasn't been refreshed yet, it returns
+        `None`.
+        
+        :param design: The name of the design document.
+        """
+        if design is not None:
+            designs = [design]
+        else:
+            designs = set(viewdef.design for viewdef in self.viewdefs())
+        times = [self.refreshed.get(name) for name in designs]
+        if not times or None in times:
+            return None
+        return time.time() - min(times)
+    
+    def refresh(self):
+        """
+        This brings the index of every design document up to date once.
+        """
+        views = {}
+        for viewdef in self.viewdefs():
+            views.setdefault(viewdef.design, viewdef.name)
+        for design, name in views.iteritems():
+            # the index is up to date with everything before the query
+            started = time.time()
+            self.db.view('%s/%s' % (design, name), limit=0).rows
+            self.refreshed[design] = started
+    
+    def run(self):
+        # nobody is waiting on the refreshes, so they aren't slow queries
+        _stats_state.background = True
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+                self.error = None
+            except Exception:
+                self.error = sys.exc_info()[1]
+            self._stopped.wait(self.interval)
+
+
+### Background calls
+
+class AsyncResult(object):
+    """
+    This is the result of a call that is running in the background (see
+    `call_async`). Use `get` to wait for it to finish.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+    
+    def ready(self):
+        """
+        This returns whether the call has finished.
+        """
+        return self._done.is_set()
+    
+    def get(self):
+        """
+        This waits for the call to finish and returns its result. If the call
+        raised an exception, it is raised again here.
+        """
+        self._done.wait()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._value
+    
+    def _finish(self, value=None, error=None):
+        self._value = value
+        self._error = error
+        self._done.set()
+
+
+class _WorkerPool(object):
+    """
+    This is a fixed number of daemon threads that run calls from a queue.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.pid = os.getpid()
+        self.queue = Queue.Queue()
+        for n in xrange(size):
+            thread = threading.Thread(target=self._work,
+                                      name='couchdb-worker-%d' % n)
+            thread.daemon = True
+            thread.start()
+    
+    def _work(self):
+        _worker_state.active = True
+        while True:
+            fn, args, kwargs, result, stats = self.queue.get()
+            # the calls are recorded for the request that submitted them
+            _stats_state.stats = stats
+            try:
+                result._finish(fn(*args, **kwargs))
+            except Exception:
+                result._finish(error=sys.exc_info())
+            finally:
+                _stats_state.stats = None
+    
+    def submit(self, fn, args, kwargs):
+        result = AsyncResult()
+        stats = getattr(_stats_state, 'stats', None)
+        self.queue.put((fn, args, kwargs, result, stats))
+        return result
+
+
+_workers = None
+_workers_lock = threading.Lock()
+_worker_state = threading.local()
+
+
+def call_async(fn, *args, **kwargs):
+    """
+    This runs ``fn(*args, **kwargs)`` in the background, and returns an
+    `AsyncResult` for it right away. The calls are run by a pool of threads
+    shared by the whole process, so a request can have several CouchDB
+    requests in flight at the same time without starting any threads of its
+    own. The number of threads is set by the `COUCHDB_ASYNC_WORKERS` config
+    value of the app that uses them first (defaults to 10).
+    
+    The calls don't have access to the request context, so they have to be
+    given their database explicitly. (The ``_async`` methods of `Document`
+    and `ViewDefinition` take care of that.)
+    
+    :param fn: The function to call.
+    :param args: Positional arguments to pass to it.
+    :param kwargs: Keyword arguments to pass to it.
+    """
+    global _workers
+    workers = _workers
+    if workers is None or workers.pid != os.getpid():
+        with _workers_lock:
+            workers = _workers
+            if workers is None or workers.pid != os.getpid():
+                size = 10
+                if current_app:
+                    size = current_app.config.get('COUCHDB_ASYNC_WORKERS', 10)
+                workers = _workers = _WorkerPool(size)
+    return workers.submit(fn, args, kwargs)
+
+
+def _fetch_results(results):
+    results.rows    # fetches them
+    return results
+
+
+def gather(*calls):
+    """
+    This runs several view queries, document loads, or other calls at the
+    same time, and returns a list of their results in the same order. That
+    way, a request only has to wait as long as the slowest of them, not for
+    all of them one after another. ::
+    
+        posts, tags, user = gather(
+            BlogPost.by_author[author],
+            tag_counts(group=True),
+            User.load_async(user_id)
+        )
+    
+    Every argument can be:
+    
+    - `ViewResults` (what you get by calling or slicing a `ViewDefinition`)
+      or a `ViewDefinition`, which will be fetched. The result is the
+      `ViewResults`, with its rows already fetched.
+    - An `AsyncResult`, like the ones from `Document.load_async`. The result
+      is its result.
+    - Any function that takes no arguments. The result is what it returns.
+    
+    The calls are run by the pool of threads `call_async` uses, except for
+    the first, which is run in the current thread. If any of them raises an
+    exception, the first one is raised again here.
+    
+    :param calls: The calls to run.
+    """
+    # calls made from a worker are run in place, since queueing them could
+    # leave every worker waiting for work nobody is free to do
+    inline = getattr(_worker_state, 'active', False)
+    pending = []
+    for call in calls:
+        if isinstance(call, OldViewDefinition):
+            call = call()
+        if isinstance(call, ViewResults):
+            call = functools.partial(_fetch_results, call)
+        pending.append(call)
+    for n, call in enumerate(pending):
+        if n > 0 and not inline and not isinstance(call, AsyncResult):
+            pending[n] = call_async(call)
+    for n, call in enumerate(pending):
+        if not isinstance(call, AsyncResult):
+            pending[n] = result = AsyncResult()
+            try:
+                result._finish(call())
+            except Exception:
+                result._finish(error=sys.exc_info())
+    return [result.get() for result in pending]
+
+
+### Instrumentation
+
+class CallRecord(object):
+    """
+    This records a single HTTP request made to CouchDB. It has the request's
+    `method`, the `path` of the URL (without the query string), the
+    response's `status` (`None` if there wasn't one), how many seconds it
+    took (`elapsed`, including reading the body), and how many bytes were
+    sent in the request body (`bytes_out`) and read from the response body
+    (`bytes_in`). If the call was sampled (see `COUCHDB_QUERY_SAMPLE_RATE`),
+    `stack` is the stack it was made from, as returned by
+    `traceback.extract_stack`.
+    """
+    __slots__ = ('method', 'path', 'status', 'elapsed', 'bytes_in',
+                 'bytes_out', 'stack')
+    
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.status = None
+        self.elapsed = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.stack = None
+    
+    def __repr__(self):
+        return '<CallRecord %s %s %s %.1fms>' % (self.method, self.path,
+                                                 self.status,
+                                                 self.elapsed * 1000)
+
+
+class RequestStats(object):
+    """
+    This collects the HTTP requests made to CouchDB while handling a request,
+    including the ones `call_async` makes in the background on its behalf.
+    It is available as ``g.couch_stats`` during the request, and it is passed
+    to the `~CouchDBManager.on_request_stats` callbacks at the end.
+    """
+    def __init__(self, endpoint=None):
+        #: The endpoint of the request.
+        self.endpoint = endpoint
+        #: The `CallRecord` for every HTTP request, in the order they were
+        #: made.
+        self.calls = []
+    
+    def __len__(self):
+        return len(self.calls)
+    
+    @property
+    def elapsed(self):
+        """
+        The total number of seconds the calls took. (Calls made at the same
+        time are all counted.)
+        """
+        return sum(call.elapsed for call in self.calls)
+    
+    @property
+    def bytes_in(self):
+        """
+        The total number of bytes read from the responses.
+        """
+        return sum(call.bytes_in for call in self.calls)
+    
+    @property
+    def bytes_out(self):
+        """
+        The total number of bytes sent in the requests.
+        """
+        return sum(call.bytes_out for call in self.calls)
+    
+    def server_timing(self):
+        """
+        This returns the stats as a ``Server-Timing`` header value.
+        """
+        return 'couchdb;dur=%.1f;desc="%d calls"' % (self.elapsed * 1000,
+                                                     len(self.calls))
+
+
+_stats_state = threading.local()
+_log = logging.getLogger('flaskext.couchdb')
+
+# couchdb-python only has Forbidden since 1.2 - before that, a 403 is a
+# ServerError like any other status
+_ERROR_STATUSES = [(http.Unauthorized, 401),
+                   (getattr(http, 'Forbidden', None), 403),
+                   (http.ResourceNotFound, 404), (http.ResourceConflict, 409),
+                   (http.PreconditionFailed, 412)]
+_ERROR_STATUSES = [(cls, status) for cls, status in _ERROR_STATUSES
+                   if cls is not None]
+
+
+def _error_status(error):
+    if isinstance(error, http.ServerError):
+        return error.args[0][0]
+    for cls, status in _ERROR_STATUSES:
+        if isinstance(error, cls):
+            return status
+
+
+class _CountingBody(object):
+    """
+    This wraps a response body, and adds the bytes read from it (and the
+    time it took to read them) to a `CallRecord`. Once the whole body has
+    been read, `done` is called.
+    """
+    def __init__(self, body, call, done):
+        self._body = body
+        self._call = call
+        self._done = done
+    
+    def __getattr__(self, name):
+        return getattr(self._body, name)
+    
+    def read(self, size=None):
+        started = time.time()
+        if size is None:
+            data = self._body.read()
+        else:
+            data = self._body.read(size)
+        self._call.elapsed += time.time() - started
+        self._call.bytes_in += len(data)
+        if self._done is not None and (size is None or len(data) < size):
+            done, self._done = self._done, None
+            done()
+        return data
+
+
+class _InstrumentedSession(http.Session):
+    """
+    This is a `couchdb.http.Session` that records every request it makes in
+    the `RequestStats` of the current request, if there is one, and logs the
+    ones that take longer than `slow_query_ms`.
+    """
+    #: Calls that take at least this many milliseconds are logged, unless
+    #: it is `None`.
+    slow_query_ms = None
+    
+    #: The fraction of the calls made during requests whose stacks are
+    #: captured.
+    sample_rate = 0
+    
+    def request(self, method, url, body=None, headers=None, credentials=None,
+                num_redirects=0):
+        stats = getattr(_stats_state, 'stats', None)
+        if stats is None and (self.slow_query_ms is None or
+                              getattr(_stats_state, 'background', False)):
+            return http.Session.request(self, method, url, body, headers,
+                                        credentials, num_redirects)
+        call = CallRecord(method.upper(), urlparse.urlsplit(url).path)
+        if (stats is not None and self.sample_rate and
+                random.random() < self.sample_rate):
+            call.stack = traceback.extract_stack()[:-1]
+        # the session fills in the Content-Length
+        if headers is None:
+            headers = {}
+        cached = self.cache.by_url.get(url)
+        done = lambda: self._finished(call, url, stats)
+        started = time.time()
+        try:
+            status, msg, data = http.Session.request(
+                self, method, url, body, headers, credentials, num_redirects
+            )
+        except Exception:
+            call.status = _error_status(sys.exc_info()[1])
+            call.elapsed = time.time() - started
+            done()
+            raise
+        finally:
+            call.elapsed = time.time() - started
+            call.bytes_out = int(headers.get('Content-Length') or 0)
+            if stats is not None:
+                stats.calls.append(call)
+        if cached is not None and msg is cached[1]:
+            # the cached body was used, so nothing else was sent
+            call.status = 304
+            done()
+        else:
+            call.status = status
+            if data is None:
+                done()
+            else:
+                data = _CountingBody(data, call, done)
+        return status, msg, data
+    
+    def _finished(self, call, url, stats):
+        if (self.slow_query_ms is None or
+                call.elapsed * 1000 < self.slow_query_ms):
+            return
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        # feeds wait for changes on purpose
+        if urlparse.parse_qs(query).get('feed') in (['longpoll'],
+                                                    ['continuous']):
+            return
+        # this is still called from the code that made the call
+        stack = call.stack or traceback.extract_stack()[:-1]
+        _log.warning(
+            'Slow CouchDB call (%.1fms) from endpoint %s: %s %s\n%s',
+            call.elapsed * 1000, stats.endpoint if stats is not None else None,
+            call.method, path + ('?' + query if query else ''),
+            ''.join(traceback.format_list(stack)).rstrip()
+        )
+
+
 ### The manager class
 
 class CouchDBManager(object):
@@ -37,20 +847,59 @@ class CouchDBManager(object):
     
     :param auto_sync: Whether to automatically sync the database every
                       request. (Defaults to `True`.)
+    :param sync_once: If this is `True`, automatic syncing will only happen
+                      on the first request for each app, and afterwards only
+                      when the registered views or the database configuration
+                      change. (Defaults to `False`.)
+    :param warm_views: If this is `True`, changed design documents are put
+                       in place by a `ViewWarmer` once their views are
+                       indexed, instead of right away. (Defaults to `False`.)
+    :param stale_views: The ``stale`` option (``'ok'`` or ``'update_after'``)
+                        to read views with, unless the `ViewDefinition` or
+                        the query says otherwise. If it is set, a
+                        `ViewRefresher` keeps the indexes up to date.
+                        (Defaults to `None`, which reads them fresh.)
+    :param refresh_interval: How many seconds the `ViewRefresher` waits
+                             between refreshes. (Defaults to 10.)
     """
-    def __init__(self, auto_sync=True):
+    def __init__(self, auto_sync=True, sync_once=False, warm_views=False,
+                 stale_views=None, refresh_interval=10):
         self.auto_sync = auto_sync
+        self.sync_once = sync_once
+        self.warm_views = warm_views
+        self.stale_views = stale_views
+        self.refresh_interval = refresh_interval
         self.dc_viewdefs = {}
         self.general_viewdefs = []
         self.sync_callbacks = []
+        self.stats_callbacks = []
+        self._all_viewdefs = None
+        self._viewdefs_fingerprint = None
+        self._synced = weakref.WeakKeyDictionary()
+        self._sync_lock = threading.Lock()
+        self._connections = weakref.WeakKeyDictionary()
+        self._connections_lock = threading.Lock()
+        self._listen_changes = weakref.WeakKeyDictionary()
+        self._listeners = weakref.WeakKeyDictionary()
+        self._warmers = weakref.WeakKeyDictionary()
+        self._warming = weakref.WeakKeyDictionary()
+        self._refreshers = weakref.WeakKeyDictionary()
     
     def all_viewdefs(self):
         """
-        This iterates through all the view definitions registered generally
-        and the ones on specific document classes.
+        This returns a tuple of all the view definitions registered generally
+        and the ones on specific document classes. (It is only worked out
+        again after another view definition or document class is added.)
         """
-        return itertools.chain(self.general_viewdefs,
-                               *self.dc_viewdefs.itervalues())
+        if self._all_viewdefs is None:
+            self._all_viewdefs = tuple(itertools.chain(
+                self.general_viewdefs, *self.dc_viewdefs.itervalues()
+            ))
+        return self._all_viewdefs
+    
+    def _viewdefs_changed(self):
+        self._all_viewdefs = None
+        self._viewdefs_fingerprint = None
     
     def add_document(self, dc):
         """
@@ -59,13 +908,21 @@ class CouchDBManager(object):
         
         :param dc: The class to add. It should be a subclass of `Document`.
         """
-        viewdefs = []
-        for name in dir(dc):
-            item = getattr(dc, name)
-            if isinstance(item, OldViewDefinition):
-                viewdefs.append(item)
-        if viewdefs:
-            self.dc_viewdefs[dc] = viewdefs
+        # the views are found in the class dictionaries, so no other
+        # attributes have to be looked up - an attribute in a subclass
+        # hides one with the same name further down the MRO
+        found = {}
+        for klass in reversed(dc.__mro__):
+            for name, item in vars(klass).iteritems():
+                if isinstance(item, mapping.ViewField):
+                    found[name] = item.__get__(None, dc)
+                elif isinstance(item, OldViewDefinition):
+                    found[name] = item
+                else:
+                    found.pop(name, None)
+        if found:
+            self.dc_viewdefs[dc] = tuple(found[name] for name in sorted(found))
+            self._viewdefs_changed()
     
     def add_viewdef(self, viewdef):
         """
@@ -80,6 +937,52 @@ class CouchDBManager(object):
             self.general_viewdefs.append(viewdef)
         else:
             self.general_viewdefs.extend(viewdef)
+        self._viewdefs_changed()
+    
+    def fingerprint(self):
+        """
+        This returns a hash of every view definition registered with the
+        manager (design document, name, language, options, and the map and
+        reduce functions). It changes whenever a view is added or changed, so
+        it can be used to tell whether the design documents need to be synced
+        again.
+        """
+        if self._viewdefs_fingerprint is None:
+            digest = hashlib.sha1()
+            viewdefs = sorted(self.all_viewdefs(),
+                              key=lambda vd: (vd.design, vd.name))
+            for vd in viewdefs:
+                for part in (vd.design, vd.name, vd.language, vd.map_fun,
+                             vd.reduce_fun or u'', repr(vd.options)):
+                    if isinstance(part, unicode):
+                        part = part.encode('utf-8')
+                    digest.update(part)
+                    digest.update('\0')
+            self._viewdefs_fingerprint = digest.hexdigest()
+        return self._viewdefs_fingerprint
+    
+    def needs_sync(self, app):
+        """
+        This checks whether the database for the given app has to be synced,
+        i.e. it has never been synced by this manager, or the view
+        definitions or database configuration have changed since the last
+        time it was. While a `ViewWarmer` is still putting the current view
+        definitions in place, the app doesn't have to be synced again.
+        
+        :param app: The app to check.
+        """
+        key = self._sync_key(app)
+        if self._synced.get(app) == key:
+            return False
+        warmer = self._warmers.get(app)
+        return (warmer is None or not warmer.is_alive() or
+                self._warming.get(app) != key)
+    
+    def _sync_key(self, app):
+        config = app.config
+        return (config['COUCHDB_SERVER'], config['COUCHDB_DATABASE'],
+                config.get('COUCHDB_USERNAME'), config.get('COUCHDB_PASSWORD'),
+                self.fingerprint())
     
     def on_sync(self, fn):
         """
@@ -99,20 +1002,87 @@ class CouchDBManager(object):
         """
         self.sync_callbacks.append(fn)
     
+    def on_request_stats(self, fn):
+        """
+        This adds a callback to run at the end of every request, with the
+        request's `RequestStats`. It can log them, or look for requests that
+        make a lot of calls, or the like.
+        
+        If the `COUCHDB_SERVER_TIMING` config value is `True`, the stats are
+        also sent to the client in a ``Server-Timing`` header.
+        
+        :param fn: The callback function to add.
+        """
+        self.stats_callbacks.append(fn)
+    
+    def _connection_key(self, app):
+        config = app.config
+        return (config['COUCHDB_SERVER'], config['COUCHDB_DATABASE'],
+                config.get('COUCHDB_USERNAME'), config.get('COUCHDB_PASSWORD'),
+                config.get('COUCHDB_POOL_SIZE', 10),
+                config.get('COUCHDB_POOL_TIMEOUT'),
+                config.get('COUCHDB_DOCUMENT_CACHE_SIZE'),
+                config.get('COUCHDB_DOCUMENT_CACHE_BYTES', 10 * 1024 * 1024),
+                config.get('COUCHDB_SLOW_QUERY_MS'),
+                config.get('COUCHDB_QUERY_SAMPLE_RATE', 0))
+    
+    def _connect(self, app):
+        """
+        This returns the shared `couchdb.Server` and `couchdb.Database` for
+        the given app, creating them (and their connection pool and cache) if
+        they don't exist yet, the app's configuration has changed, or they
+        were created in another process. (A process forked from the one that
+        created them would otherwise share its open sockets.)
+        """
+        key = self._connection_key(app)
+        pid = os.getpid()
+        conn = self._connections.get(app)
+        if conn is None or conn[0] != key or conn[1] != pid:
+            with self._connections_lock:
+                conn = self._connections.get(app)
+                if conn is None or conn[0] != key or conn[1] != pid:
+                    (server_url, db_name, username, password, pool_size,
+                     pool_timeout, cache_size, cache_bytes, slow_query_ms,
+                     sample_rate) = key
+                    session = _InstrumentedSession()
+                    session.slow_query_ms = slow_query_ms
+                    session.sample_rate = sample_rate
+                    session.connection_pool = _BoundedConnectionPool(
+                        pool_size, pool_timeout
+                    )
+                    if cache_size:
+                        session.cache = DocumentCache(cache_size, cache_bytes)
+                    server = couchdb.Server(server_url, session=session)
+                    if username is not None and password is not None:
+                        server.resource.credentials = (username, password)
+                    db = couchdb.Database(server.resource(db_name), db_name)
+                    if self.stale_views:
+                        _stale_reads[db] = self.stale_views
+                    conn = self._connections[app] = (key, pid, server, db)
+        return conn[2], conn[3]
+    
     def connect_db(self, app):
         """
-        This connects to the database for the given app. It presupposes that
-        the database has already been synced, and as such an error will be
-        raised if the database does not exist.
+        This returns the database for the given app. It presupposes that the
+        database has already been synced, and doesn't check whether it
+        exists - if it doesn't, you will get errors when you try to use it.
+        
+        The database object (and the HTTP connections behind it) are shared
+        between all the requests for the app in the same process. The size of the connection pool
+        is set by the `COUCHDB_POOL_SIZE` config value (defaults to 10), and
+        `COUCHDB_POOL_TIMEOUT` is the number of seconds to wait for a free
+        connection before raising `ConnectionPoolTimeout` (defaults to `None`,
+        which waits forever).
+        
+        If `COUCHDB_DOCUMENT_CACHE_SIZE` is set, responses (most importantly,
+        documents fetched by `Document.load`) are kept in a `DocumentCache`
+        with at most that many entries and at most
+        `COUCHDB_DOCUMENT_CACHE_BYTES` bytes (defaults to 10 MiB), and
+        revalidated with their ETags.
         
         :param app: The app to get the settings from.
         """
-        server_url = app.config['COUCHDB_SERVER']
-        db_name = app.config['COUCHDB_DATABASE']
-        server = couchdb.Server(server_url)
-        if 'COUCHDB_USERNAME' in app.config and 'COUCHDB_PASSWORD' in app.config:
-          server.resource.credentials = (app.config['COUCHDB_USERNAME'], app.config['COUCHDB_PASSWORD'])
-        return server[db_name]
+        return self._connect(app)[1]
     
     def sync(self, app):
         """
@@ -125,46 +1095,338 @@ class CouchDBManager(object):
         exists on the manager, it will be called before every design document
         is updated.
         
+        If the manager was created with ``warm_views=True``, the changed
+        design documents are handed to a `ViewWarmer` instead of being saved,
+        so they are only put in place once their views are indexed. (While
+        it is running, other syncs leave the design documents alone.) The
+        app only counts as synced once the warmer has put them all in place,
+        but `needs_sync` doesn't ask for another sync while it is running,
+        unless the view definitions or configuration change. If it fails,
+        the next sync tries again.
+        
         :param app: The application to synchronize with.
         """
-        server_url = app.config['COUCHDB_SERVER']
-        db_name = app.config['COUCHDB_DATABASE']
-        server = couchdb.Server(server_url)
-        if 'COUCHDB_USERNAME' in app.config and 'COUCHDB_PASSWORD' in app.config:
-          server.resource.credentials = (app.config['COUCHDB_USERNAME'], app.config['COUCHDB_PASSWORD'])
-        if db_name not in server:
-            db = server.create(db_name)
+        key = self._sync_key(app)
+        server, db = self._connect(app)
+        if db.name not in server:
+            server.create(db.name)
+        callback = getattr(self, 'update_design_doc', None)
+        synced = True
+        if self.warm_views:
+            warmer = self._warmers.get(app)
+            if warmer is not None and warmer.is_alive():
+                # the views it is warming may not be the latest ones, so
+                # they're synced again once it is done
+                synced = False
+                self._warming[app] = key
+            else:
+                collector = _DesignDocCollector(db)
+                OldViewDefinition.sync_many(collector, self.all_viewdefs(),
+                                            callback=callback)
+                if collector.docs:
+                    synced = False
+                    self._warming[app] = key
+                    warmer = self._warmers[app] = ViewWarmer(db,
+                        collector.docs, callback=self._warmed(app, key))
+                    warmer.start()
         else:
-            db = server[db_name]
-        OldViewDefinition.sync_many(
-            db, tuple(self.all_viewdefs()),
-            callback=getattr(self, 'update_design_doc', None)
-        )
+            OldViewDefinition.sync_many(db, self.all_viewdefs(),
+                                        callback=callback)
         for callback in self.sync_callbacks:
             callback(db)
+        if synced:
+            self._synced[app] = key
     
-    def setup(self, app):
+    def _warmed(self, app, key):
+        """
+        This returns the callback for a `ViewWarmer` that marks the app as
+        synced with `key`. It only holds a weak reference to the app, since
+        the warmer is kept in a registry keyed on it.
+        """
+        app_ref = weakref.ref(app)
+        def warmed():
+            app = app_ref()
+            if app is not None:
+                self._synced[app] = key
+        return warmed
+    
+    def setup(self, app, listen_changes=False):
         """
         This method sets up the request/response handlers needed to connect to
         the database on every request.
         
+        If `listen_changes` is `True`, every process will follow the
+        database's changes feed in a background thread (a `ChangesListener`,
+        started the first time the database is used), and remove changed
+        documents and view results from the `DocumentCache` and any
+        `ViewCache` as soon as they change. While it is connected, the caches
+        don't have to check with the database before they are used.
+        
         :param app: The application to set up.
+        :param listen_changes: Whether to follow the changes feed.
         """
         app.before_request(self.request_start)
         app.after_request(self.request_end)
+        if listen_changes:
+            self._listen_changes[app] = True
+    
+    def view_warmer(self, app):
+        """
+        This returns the last `ViewWarmer` started for the given app, or
+        `None` if there hasn't been one.
+        
+        :param app: The app to check.
+        """
+        return self._warmers.get(app)
+    
+    def view_caches(self):
+        """
+        This returns the `ViewCache` instances used by the registered view
+        definitions.
+        """
+        caches = []
+        for viewdef in self.all_viewdefs():
+            if viewdef.cache is not None and viewdef.cache not in caches:
+                caches.append(viewdef.cache)
+        return caches
+    
+    def _listen(self, app, db):
+        """
+        This makes sure a `ChangesListener` is running for the given app in
+        this process.
+        """
+        def make_listener():
+            listener = ChangesListener(
+                db, lambda ids: self._invalidate(listener, ids)
+            )
+            return listener
+        self._start_thread(self._listeners, app, db, make_listener)
+    
+    def _refresh(self, app, db):
+        """
+        This makes sure a `ViewRefresher` is running for the given app in this
+        process.
+        """
+        self._start_thread(self._refreshers, app, db, lambda: ViewRefresher(
+            db, self.all_viewdefs, self.refresh_interval
+        ))
+    
+    def _start_thread(self, threads, app, db, factory):
+        """
+        This starts a thread made by `factory` for the given app, unless
+        there is already one in `threads` for the same database and process.
+        (Threads don't survive forking, so a thread started before a server
+        forks its workers has to be replaced.)
+        """
+        thread = threads.get(app)
+        if (thread is not None and thread.db is db and
+                thread.pid == os.getpid()):
+            return
+        with self._connections_lock:
+            thread = threads.get(app)
+            if (thread is not None and thread.db is db and
+                    thread.pid == os.getpid()):
+                return
+            if thread is not None:
+                thread.stop()
+            thread = threads[app] = factory()
+            thread.start()
+    
+    def view_refresher(self, app):
+        """
+        This returns the `ViewRefresher` for the given app in this process,
+        or `None` if there isn't one. Its `~ViewRefresher.staleness` is how
+        far behind the database ``stale`` reads can be.
+        
+        :param app: The app to check.
+        """
+        return self._refreshers.get(app)
+    
+    def _invalidate(self, listener, ids):
+        """
+        This is called by a `ChangesListener` with the IDs of the documents
+        that changed, or `None` if anything could have changed.
+        """
+        db = listener.db
+        document_cache = db.resource.session.cache
+        if isinstance(document_cache, DocumentCache):
+            if ids is None:
+                document_cache.clear()
+            else:
+                for id in ids:
+                    document_cache.invalidate(_document_resource(db, id).url)
+            document_cache.listener = listener
+        for cache in self.view_caches():
+            cache.invalidate(db)
+            cache.listeners[db.resource.url] = listener
     
     def request_start(self):
-        if self.auto_sync and not current_app.config.get('DISABLE_AUTO_SYNC'):
-            self.sync(current_app)
-        g.couch = self.connect_db(current_app)
+        g.couch = LocalProxy(self._request_db)
+        g.couch_identity_map = IdentityMap()
+        g.couch_stats = _stats_state.stats = RequestStats(request.endpoint)
+    
+    def _request_db(self):
+        """
+        This is what ``g.couch`` proxies to. The database is only synced (if
+        auto syncing is on) and connected the first time it is used in a
+        request, so requests that never touch it don't cost anything.
+        """
+        db = getattr(g, '_couch_db', None)
+        if db is None:
+            app = current_app._get_current_object()
+            if self.auto_sync and not app.config.get('DISABLE_AUTO_SYNC'):
+                if not self.sync_once:
+                    self.sync(app)
+                elif self.needs_sync(app):
+                    with self._sync_lock:
+                        if self.needs_sync(app):
+                            self.sync(app)
+            db = g._couch_db = self.connect_db(app)
+            if app in self._listen_changes:
+                self._listen(app, db)
+            if self.stale_views:
+                self._refresh(app, db)
+        return db
     
     def request_end(self, response):
         del g.couch
+        g.couch_identity_map.clear()
+        del g.couch_identity_map
+        if getattr(g, '_couch_db', None) is not None:
+            del g._couch_db
+        stats = g.couch_stats
+        _stats_state.stats = None
+        del g.couch_stats
+        for callback in self.stats_callbacks:
+            callback(stats)
+        if stats.calls and current_app.config.get('COUCHDB_SERVER_TIMING'):
+            response.headers.add('Server-Timing', stats.server_timing())
         return response
 
 
 ### Jury-rigged CouchDB classes
 
+def _database(db):
+    """
+    This returns `db`, or the thread-local database (``g.couch``) if it is
+    `None`. (It doesn't use ``db or g.couch``, because checking a database's
+    truth value makes an HTTP request.) The actual database is returned, not
+    the proxy, so it can be used after the request is over.
+    """
+    if db is None:
+        db = g.couch
+    return _unproxied(db)
+
+
+def _unproxied(obj):
+    """
+    This returns the object behind `obj` if it is a `LocalProxy` (like
+    ``g.couch``), since the proxy doesn't pass `isinstance` checks.
+    """
+    if isinstance(obj, LocalProxy):
+        return obj._get_current_object()
+    return obj
+
+
+def _document_resource(db, id):
+    """
+    This returns the `couchdb.http.Resource` for the document with the given
+    ID in `db`.
+    """
+    if id.startswith('_design/'):
+        return db.resource('_design', id[8:])
+    return db.resource(id)
+
+
+def _stored(db, ids):
+    """
+    This throws away what the caches know about the given documents after
+    this process saved them: their responses in the `DocumentCache`, and
+    every `ViewCache`'s results for the database. (Other processes find out
+    from the changes feed, if they follow it, or by revalidating.)
+    """
+    document_cache = db.resource.session.cache
+    if isinstance(document_cache, DocumentCache):
+        for id in ids:
+            document_cache.invalidate(_document_resource(db, id).url)
+    for cache in list(_view_caches):
+        cache.invalidate(db)
+
+
+def _identity_map(db):
+    """
+    This returns the request's `IdentityMap` if `db` is `None` (that is, the
+    thread-local database is being used) and there is one.
+    """
+    if db is None:
+        return getattr(g, 'couch_identity_map', None)
+    return None
+
+
+class IdentityMap(object):
+    """
+    This keeps track of the documents loaded during a single request, so that
+    loading the same document twice returns the same instance without asking
+    the database again. The manager puts one in ``g.couch_identity_map`` at
+    the start of every request, and `Document.load` and `Document.load_many`
+    use it whenever they use ``g.couch``.
+    """
+    #: The number of loads that were answered from the map.
+    hits = 0
+    
+    #: The number of loads that had to go to the database.
+    misses = 0
+    
+    def __init__(self):
+        self.documents = {}
+    
+    def __repr__(self):
+        return '<IdentityMap %d documents, %d hits, %d misses>' % (
+            len(self.documents), self.hits, self.misses
+        )
+    
+    def __len__(self):
+        return len(self.documents)
+    
+    def get(self, cls, id):
+        """
+        This returns the instance of `cls` with the given ID, or `None` if it
+        hasn't been loaded yet. It updates the `hits` and `misses` counters.
+        
+        :param cls: The document class.
+        :param id: The document ID.
+        """
+        doc = self.documents.get((cls, id))
+        if doc is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return doc
+    
+    def add(self, doc):
+        """
+        This adds a loaded document to the map.
+        
+        :param doc: The document to add.
+        """
+        self.documents[(type(doc), doc.id)] = doc
+    
+    def discard(self, doc):
+        """
+        This removes a document from the map, if it is there.
+        
+        :param doc: The document to remove.
+        """
+        self.documents.pop((type(doc), doc.id), None)
+    
+    def clear(self):
+        """
+        This removes all the documents from the map and resets the counters.
+        """
+        self.documents.clear()
+        self.hits = self.misses = 0
+
+
 class Document(mapping.Document):
     """
     This class can be used to represent a single "type" of document. You can
@@ -183,6 +1445,23 @@ class Document(mapping.Document):
         if hasattr(cls, 'doc_type'):
             self._data['doc_type'] = cls.doc_type
     
+    @classmethod
+    def wrap(cls, data):
+        """
+        This creates an instance of the class around a document's data (as a
+        `dict`), like when it is loaded or comes from a view. Unlike the
+        constructor, it doesn't work out a default for every field, since
+        they would all be replaced by `data` anyway. (Classes that override
+        `__init__` still have it called.)
+        
+        :param data: The document's data.
+        """
+        if cls.__init__.__func__ is not Document.__init__.__func__:
+            return super(Document, cls).wrap(data)
+        instance = cls.__new__(cls)
+        instance._data = data
+        return instance
+    
     @classmethod
     def load(cls, id, db=None):
         """
@@ -190,6 +1469,12 @@ class Document(mapping.Document):
         database is not given, the thread-local database (``g.couch``) is
         used. 
         
+        When ``g.couch`` is used, the document is remembered in the request's
+        `IdentityMap`, so loading it again during the same request returns the
+        same instance without asking the database. If the `DocumentCache` is
+        enabled, documents are also cached between requests, and only fetched
+        again if they have changed.
+        
         For compatibility with code used to the parameter ordering used in the
         original CouchDB library, the parameters can be given in reverse
         order.
@@ -197,9 +1482,82 @@ class Document(mapping.Document):
         :param id: The document ID to load.
         :param db: The database to use. Optional.
         """
-        if isinstance(id, couchdb.Database):
-            id, db = db, id
-        return super(Document, cls).load(db or g.couch, id)
+        if isinstance(_unproxied(id), couchdb.Database):
+            id, db = db, _unproxied(id)
+        identity_map = _identity_map(db)
+        if identity_map is not None:
+            doc = identity_map.get(cls, id)
+            if doc is not None:
+                return doc
+        db = _database(db)
+        cache = db.resource.session.cache
+        if isinstance(cache, DocumentCache):
+            doc = cache.load(db, id)
+            if doc is not None:
+                doc = cls.wrap(doc)
+        else:
+            doc = super(Document, cls).load(db, id)
+        if identity_map is not None and doc is not None:
+            identity_map.add(doc)
+        return doc
+    
+    @classmethod
+    def load_async(cls, id, db=None):
+        """
+        This works like `load`, but it loads the document in the background
+        and returns an `AsyncResult` right away. (It doesn't use the request's
+        `IdentityMap`.)
+        
+        :param id: The document ID to load.
+        :param db: The database to use. Optional.
+        """
+        if isinstance(_unproxied(id), couchdb.Database):
+            id, db = db, _unproxied(id)
+        return call_async(cls.load, id, _database(db))
+    
+    @classmethod
+    def load_many(cls, ids, db=None, chunk_size=500):
+        """
+        This retrieves several documents at once, using one request to the
+        database's ``_all_docs`` view for every `chunk_size` IDs instead of
+        one request per document. If a database is not given, the
+        thread-local database (``g.couch``) is used.
+        
+        It returns a list with a document for every ID, in the same order as
+        `ids`. If the document with a given ID does not exist (or was
+        deleted), its place in the list will be `None`.
+        Documents that are already in the request's `IdentityMap` are not
+        requested again.
+        
+        :param ids: The document IDs to load.
+        :param db: The database to use. Optional.
+        :param chunk_size: The maximum number of IDs to request at once.
+        """
+        if isinstance(_unproxied(ids), couchdb.Database):
+            ids, db = db, _unproxied(ids)
+        identity_map = _identity_map(db)
+        db = _database(db)
+        ids = list(ids)
+        if identity_map is None:
+            docs = [None] * len(ids)
+        else:
+            docs = [identity_map.get(cls, id) for id in ids]
+        # an ID that is asked for more than once is still only loaded (and
+        # wrapped) once
+        missing = list(collections.OrderedDict.fromkeys(
+            id for id, doc in zip(ids, docs) if doc is None))
+        loaded = {}
+        for start in xrange(0, len(missing), chunk_size):
+            keys = missing[start:start + chunk_size]
+            rows = db.view('_all_docs', keys=keys, include_docs=True)
+            for key, row in zip(keys, rows):
+                doc = row.get('doc')
+                if doc is not None:
+                    loaded[key] = cls.wrap(doc)
+                    if identity_map is not None:
+                        identity_map.add(loaded[key])
+        return [loaded.get(id) if doc is None else doc
+                for id, doc in zip(ids, docs)]
     
     def store(self, db=None):
         """
@@ -208,12 +1566,361 @@ class Document(mapping.Document):
         
         :param db: The database to use. Optional.
         """
-        return mapping.Document.store(self, db or g.couch)
+        identity_map = _identity_map(db)
+        if identity_map is not None:
+            identity_map.discard(self)
+        db = _database(db)
+        result = mapping.Document.store(self, db)
+        _stored(db, [self.id])
+        return result
+    
+    def store_async(self, db=None):
+        """
+        This works like `store`, but it saves the document in the background
+        and returns an `AsyncResult` right away.
+        
+        :param db: The database to use. Optional.
+        """
+        identity_map = _identity_map(db)
+        if identity_map is not None:
+            identity_map.discard(self)
+        return call_async(self.store, _database(db))
+    
+    @classmethod
+    def store_many(cls, docs, db=None, batch_size=500, all_or_nothing=False):
+        """
+        This saves several documents at once, using one request to the
+        database's ``_bulk_docs`` API for every `batch_size` documents. If a
+        database is not given, the thread-local database (``g.couch``) is
+        used.
+        
+        The ID and revision of every document that was saved are updated in
+        place. Documents that could not be saved (because of a conflict, or
+        because a validation function rejected them) are left alone. Either
+        way, it returns a list with a `StoreResult` for every document, in the
+        same order as `docs`.
+        
+        :param docs: The documents to save. Plain dicts work too.
+        :param db: The database to use. Optional.
+        :param batch_size: The maximum number of documents to save at once.
+        :param all_or_nothing: If this is `True`, CouchDB will either save
+                               every document in a batch or none of them.
+                               (Only one batch is atomic, so use a big enough
+                               `batch_size`.)
+        """
+        if isinstance(_unproxied(docs), couchdb.Database):
+            docs, db = db, _unproxied(docs)
+        identity_map = _identity_map(db)
+        db = _database(db)
+        docs = list(docs)
+        if identity_map is not None:
+            for doc in docs:
+                if isinstance(doc, mapping.Document):
+                    identity_map.discard(doc)
+        results = []
+        for start in xrange(0, len(docs), batch_size):
+            batch = docs[start:start + batch_size]
+            data = [getattr(doc, '_data', doc) for doc in batch]
+            body = {'docs': data}
+            if all_or_nothing:
+                body['all_or_nothing'] = True
+            _, _, response = db.resource.post_json('_bulk_docs', body=body)
+            for doc, fields, result in zip(batch, data, response):
+                if 'error' in result:
+                    results.append(StoreResult(doc, result.get('id'),
+                                               error=result['error'],
+                                               reason=result.get('reason')))
+                else:
+                    fields['_id'] = result['id']
+                    fields['_rev'] = result['rev']
+                    results.append(StoreResult(doc, result['id'],
+                                               result['rev']))
+            _stored(db, [result['id'] for result in response
+                         if 'error' not in result])
+        return results
+
 
+class StoreResult(object):
+    """
+    This represents the outcome of saving a single document with
+    `Document.store_many`.
+    """
+    #: The document that was saved.
+    document = None
+    
+    #: The ID of the document.
+    id = None
+    
+    #: The new revision of the document, if it was saved. If not, this is
+    #: `None`.
+    rev = None
+    
+    #: The error CouchDB reported, like ``'conflict'`` or ``'forbidden'``. If
+    #: the document was saved, this is `None`.
+    error = None
+    
+    #: The reason CouchDB gave for the error, if there was one.
+    reason = None
+    
+    def __init__(self, document, id, rev=None, error=None, reason=None):
+        self.document = document
+        self.id = id
+        self.rev = rev
+        self.error = error
+        self.reason = reason
+    
+    def __repr__(self):
+        if self.ok:
+            return '<StoreResult %r ok %r>' % (self.id, self.rev)
+        return '<StoreResult %r %s>' % (self.id, self.error)
+    
+    @property
+    def ok(self):
+        """Whether the document was saved."""
+        return self.error is None
+    
+    @property
+    def conflict(self):
+        """Whether the document wasn't saved because of a revision conflict."""
+        return self.error == 'conflict'
+    
+    @property
+    def forbidden(self):
+        """Whether a validation function refused to save the document."""
+        return self.error == 'forbidden'
+
+
+def _copy_json(value):
+    """
+    This copies a decoded JSON value, so that cached view results can't be
+    changed by whoever uses them. (It's a lot faster than `copy.deepcopy`.)
+    """
+    if isinstance(value, dict):
+        return dict((k, _copy_json(v)) for k, v in value.iteritems())
+    elif isinstance(value, list):
+        return [_copy_json(v) for v in value]
+    return value
 
-# just overridden to use the thread database
+
+# every ViewCache, so they can be told when this process saves documents
+_view_caches = weakref.WeakSet()
+
+
+class ViewCache(object):
+    """
+    This caches the results of view queries in memory. To use it, pass it as
+    the `cache` argument of a `ViewDefinition` or `ViewField` (one cache can
+    be shared between several views). Results are cached separately for
+    every database, view, and set of query options.
+    
+    By default, every time a cached result is used, the database's
+    ``update_seq`` is checked (which is a lot cheaper than running the
+    query), and if anything in the database changed, the query is run again.
+    If you give a `ttl`, cached results are used without checking for that
+    many seconds. If `check_update_seq` is `False`, results simply expire
+    after `ttl` seconds.
+    
+    Results that were read with a ``stale`` option are checked against the
+    ``update_seq`` of the view's index (from its design document's
+    ``_info``) instead, since that lags behind the database's until the index
+    is updated.
+    
+    If the manager follows the database's changes feed (see
+    `CouchDBManager.setup`), the results for a database are thrown away
+    whenever it changes, and they don't need to be checked at all.
+    
+    :param max_entries: The maximum number of query results to keep.
+    :param max_rows: The maximum total number of rows to keep.
+    :param ttl: The number of seconds to use a result without checking it.
+    :param check_update_seq: Whether to check the database's ``update_seq``
+                             before using a result.
+    """
+    #: The number of queries answered from the cache.
+    hits = 0
+    
+    #: The number of queries that had to be run.
+    misses = 0
+    
+    def __init__(self, max_entries=100, max_rows=10000, ttl=None,
+                 check_update_seq=True):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.check_update_seq = check_update_seq
+        self.entries = collections.OrderedDict()
+        self.rows = 0
+        #: The `ChangesListener` for each database URL, if there is one.
+        self.listeners = {}
+        self.generations = {}
+        self._lock = threading.Lock()
+        _view_caches.add(self)
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def clear(self):
+        """
+        This throws away every cached result.
+        """
+        with self._lock:
+            self.entries.clear()
+            self.rows = 0
+    
+    def invalidate(self, db):
+        """
+        This throws away the cached results for the given database (by moving
+        it to a new generation, so the old results will not be used again).
+        
+        :param db: The database that changed.
+        """
+        url = db.resource.url
+        with self._lock:
+            self.generations[url] = self.generations.get(url, 0) + 1
+    
+    def fetch(self, view, options, db):
+        """
+        This returns the raw (decoded JSON) results of running `view` with the
+        given options, from the cache if possible.
+        
+        :param view: The `couchdb.client.PermanentView` to run.
+        :param options: The query options.
+        :param db: The database the view belongs to.
+        """
+        key = (view.resource.url, json.dumps(options, sort_keys=True))
+        db_url = db.resource.url
+        now = time.time()
+        with self._lock:
+            generation = self.generations.get(db_url, 0)
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+        if entry is not None and entry[3] == generation:
+            data, update_seq, checked = entry[:3]
+            listener = self.listeners.get(db_url)
+            if listener is not None and listener.connected:
+                self.hits += 1
+                return _copy_json(data)
+            elif self.ttl is not None and now - checked < self.ttl:
+                self.hits += 1
+                return _copy_json(data)
+            elif self.check_update_seq and update_seq is not None:
+                if options.get('stale'):
+                    # the result is as new as the index, not the database
+                    design = view.name.split('/')[1]
+                    info = db.info(design)['view_index']
+                else:
+                    _, _, info = db.resource.get_json()
+                if info['update_seq'] == update_seq:
+                    self.hits += 1
+                    entry[2] = now
+                    return _copy_json(data)
+        self.misses += 1
+        if self.check_update_seq:
+            data = view._exec(dict(options, update_seq=True))
+        else:
+            data = view._exec(options)
+        self._store(key, [data, data.get('update_seq'), now, generation])
+        return _copy_json(data)
+    
+    def _store(self, key, entry):
+        rows = len(entry[0]['rows'])
+        if rows > self.max_rows:
+            return
+        with self._lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.rows -= len(old[0]['rows'])
+            self.entries[key] = entry
+            self.rows += rows
+            while (len(self.entries) > self.max_entries or
+                   self.rows > self.max_rows):
+                _, old = self.entries.popitem(last=False)
+                self.rows -= len(old[0]['rows'])
+
+
+class _KeyedRow(object):
+    """
+    This is used as a view's wrapper instead of `Row` when the code reading
+    the rows needs their keys and IDs, but only some of them are actually
+    returned (like in `paginate`). It doesn't copy the row, and it is only
+    wrapped if `wrap` is called.
+    """
+    __slots__ = ('key', 'id', 'data')
+    
+    def __init__(self, data):
+        self.key = data['key']
+        self.id = data.get('id')
+        self.data = data
+    
+    def wrap(self, wrapper):
+        return wrapper(self.data) if wrapper is not None else Row(self.data)
+
+
+class _CachedViewResults(ViewResults):
+    """
+    These are `ViewResults` that get their rows through a `ViewCache`.
+    """
+    def __init__(self, view, options, cache, db):
+        ViewResults.__init__(self, view, options)
+        self.cache = cache
+        self.db = db
+    
+    def __getitem__(self, key):
+        results = ViewResults.__getitem__(self, key)
+        return _CachedViewResults(results.view, results.options, self.cache,
+                                  self.db)
+    
+    def _fetch(self):
+        data = self.cache.fetch(self.view, self.options, self.db)
+        wrapper = self.view.wrapper or Row
+        self._rows = [wrapper(row) for row in data['rows']]
+        self._total_rows = data.get('total_rows')
+        self._offset = data.get('offset', 0)
+        self._update_seq = data.get('update_seq')
+
+
+# the ``stale`` option the managers read views with, by database
+_stale_reads = weakref.WeakKeyDictionary()
+
+
+# overridden to use the thread database, and to support caching
 
 class ViewDefinition(OldViewDefinition):
+    """
+    This is couchdb-python's `~couchdb.design.ViewDefinition`, except that
+    it uses the thread-local database by default, and it can cache its
+    results in a `ViewCache` if you pass one as the `cache` argument.
+    
+    If `stale` is `None`, the view is read with the ``stale`` option from
+    the manager's ``stale_views`` policy (if there is one). Otherwise, it is
+    always read with the given ``stale`` option, or never stale if it's
+    `False`.
+    """
+    #: The `ViewCache` results are kept in, or `None`.
+    cache = None
+    
+    #: The ``stale`` option to read the view with, `False` to always read it
+    #: fresh, or `None` to use the manager's policy.
+    stale = None
+    
+    def __init__(self, design, name, map_fun, reduce_fun=None,
+                 language='javascript', wrapper=None, options=None,
+                 cache=None, stale=None, **defaults):
+        OldViewDefinition.__init__(self, design, name, map_fun, reduce_fun,
+                                   language=language, wrapper=wrapper,
+                                   options=options, **defaults)
+        self.cache = cache
+        self.stale = stale
+    
+    def _stale_options(self, db, options):
+        if 'stale' not in options:
+            stale = self.stale
+            if stale is None:
+                stale = _stale_reads.get(db)
+            if stale:
+                options['stale'] = stale
+        return options
+    
     def __call__(self, db=None, **options):
         """
         This executes the view with the given database. If a database is not
@@ -222,7 +1929,106 @@ class ViewDefinition(OldViewDefinition):
         :param db: The database to use, if necessary.
         :param options: Options to pass to the view.
         """
-        return OldViewDefinition.__call__(self, db or g.couch, **options)
+        db = _database(db)
+        options = self._stale_options(db, options)
+        results = OldViewDefinition.__call__(self, db, **options)
+        if self.cache is None:
+            return results
+        return _CachedViewResults(results.view, results.options, self.cache,
+                                  db)
+    
+    def call_async(self, db=None, **options):
+        """
+        This runs the view in the background, and returns an `AsyncResult`
+        right away. Its result is the `ViewResults`, with the rows already
+        fetched.
+        
+        :param db: The database to use, if necessary.
+        :param options: Options to pass to the view.
+        """
+        def fetch(db):
+            results = self(db, **options)
+            results.rows    # fetches them
+            return results
+        return call_async(fetch, _database(db))
+    
+    def multi(self, keys, db=None, chunk_size=500, **options):
+        """
+        This fetches the rows for several keys at once, by sending the keys in
+        the body of a single POST request (one per `chunk_size` keys) instead
+        of querying each key separately. It returns a list with a list of
+        rows for every key, in the same order as `keys`. (Keys that don't
+        have any rows get an empty list.) ::
+        
+            steve, fred = BlogPost.by_author.multi(['Steve', 'Fred'])
+        
+        :param keys: The keys to fetch.
+        :param db: The database to use, if necessary.
+        :param chunk_size: The maximum number of keys to send at once.
+        :param options: Options to pass to the view.
+        """
+        db = _database(db)
+        wrapper = options.pop('wrapper', self.wrapper)
+        # every key is only sent once, even if it was given more than once
+        encoded = [json.dumps(key, sort_keys=True) for key in keys]
+        positions = {}
+        unique = []
+        for key, encoded_key in zip(keys, encoded):
+            if encoded_key not in positions:
+                positions[encoded_key] = len(unique)
+                unique.append(key)
+        groups = [[] for key in unique]
+        for start in xrange(0, len(unique), chunk_size):
+            chunk = unique[start:start + chunk_size]
+            # compare the keys the way they come back from CouchDB
+            expected = json.loads(json.dumps(chunk))
+            n = 0
+            for row in self(db, keys=chunk, wrapper=_KeyedRow, **options):
+                while n < len(expected) and expected[n] != row.key:
+                    n += 1
+                if n == len(expected):
+                    break
+                groups[start + n].append(row.wrap(wrapper))
+        return [list(groups[positions[key]]) for key in encoded]
+    
+    def iter_rows(self, db=None, batch_size=100, **options):
+        """
+        This iterates over the rows of the view, fetching them `batch_size`
+        at a time, so only one batch has to be in memory at once no matter
+        how big the view is. (It's meant for exports and other jobs that go
+        through an entire view - the results aren't cached.) Each batch
+        starts where the last one ended, using ``startkey`` and
+        ``startkey_docid`` instead of ``skip``.
+        
+        Rows that are added or changed between batches may be missed or seen
+        twice.
+        
+        :param db: The database to use, if necessary.
+        :param batch_size: The number of rows to fetch per request.
+        :param options: Options to pass to the view.
+        """
+        if batch_size <= 0:
+            raise ValueError('batch_size must be 1 or more')
+        db = _database(db)
+        options = self._stale_options(db, options)
+        wrapper = options.pop('wrapper', self.wrapper)
+        limit = options.pop('limit', None)
+        while limit is None or limit > 0:
+            batch = batch_size if limit is None else min(limit, batch_size)
+            # one extra row tells us where the next batch starts
+            rows = OldViewDefinition.__call__(self, db, wrapper=_KeyedRow,
+                                              limit=batch + 1,
+                                              **options).rows
+            for row in rows[:batch]:
+                yield row.wrap(wrapper)
+            if len(rows) <= batch:
+                break
+            if limit is not None:
+                limit -= batch
+            nextstart = rows[batch]
+            options.update(startkey=nextstart.key, skip=0)
+            if nextstart.id is not None:
+                options['startkey_docid'] = nextstart.id
     
     def __getitem__(self, item):
         """
@@ -245,11 +2051,63 @@ class ViewDefinition(OldViewDefinition):
 # this should be transparent to the user
 
 class ViewField(mapping.ViewField):
+    def __init__(self, design, map_fun, reduce_fun=None, name=None,
+                 language='javascript', wrapper=DEFAULT, cache=None,
+                 **defaults):
+        mapping.ViewField.__init__(self, design, map_fun, reduce_fun,
+                                   name=name, language=language,
+                                   wrapper=wrapper, **defaults)
+        self.cache = cache
+        # the definitions only depend on the class, so they are only built
+        # once for each class the field is accessed through
+        self._definitions = weakref.WeakKeyDictionary()
+    
     def __get__(self, instance, cls=None):
-        wrapper = mapping.ViewField.__get__(self, instance, cls).wrapper
-        return ViewDefinition(self.design, self.name, self.map_fun,
-                              self.reduce_fun, language=self.language,
-                              wrapper=wrapper, **self.defaults)
+        if cls is None:
+            cls = type(instance)
+        viewdef = self._definitions.get(cls)
+        if viewdef is None:
+            wrapper = mapping.ViewField.__get__(self, instance, cls).wrapper
+            viewdef = ViewDefinition(self.design, self.name, self.map_fun,
+                                     self.reduce_fun, language=self.language,
+                                     wrapper=wrapper, cache=self.cache,
+                                     **self.defaults)
+            self._definitions[cls] = viewdef
+        return viewdef
+
+
+### Streaming
+
+def stream_view(view, db=None, batch_size=100, **options):
+    """
+    This returns a `Response` that sends the rows of a view to the client as
+    JSON (in the same ``{"rows": [...]}`` format CouchDB uses), while they
+    are being fetched. The rows are fetched in batches with
+    `ViewDefinition.iter_rows`, so the response starts right away and memory
+    use doesn't depend on the size of the view. The rows are sent exactly as
+    CouchDB returns them, without the view's wrapper. ::
+    
+        @app.route('/posts.json')
+        def posts_json():
+            return stream_view(BlogPost.all_posts, include_docs=True)
+    
+    :param view: A `ViewDefinition` (or `ViewField`).
+    :param db: The database to use. If it isn't given, the thread-local
+               database (``g.couch``) is used.
+    :param batch_size: The number of rows to fetch per request.
+    :param options: Options to pass to the view.
+    """
+    rows = view.iter_rows(_database(db), batch_size, wrapper=None, **options)
+    
+    def generate():
+        yield '{"rows": ['
+        separator = '\n'
+        for row in rows:
+            yield separator + json.dumps(row)
+            separator = ',\n'
+        yield '\n]}\n'
+    
+    return Response(generate(), mimetype='application/json')
 
 
 ### Pagination
@@ -270,10 +2128,26 @@ class Page(object):
     #: this is `None`.
     prev = None
     
-    def __init__(self, items, next=None, prev=None):
+    #: The number of the page, if it was created by `paginate_numbered`. In
+    #: that case, `next` and `prev` are page numbers too.
+    number = None
+    
+    #: The total number of items on all the pages, if it is known.
+    #: Otherwise, this is `None`.
+    total_rows = None
+    
+    #: The number of pages, if the total number of items is known.
+    page_count = None
+    
+    def __init__(self, items, next=None, prev=None, number=None,
+                 total_rows=None, per_page=None):
         self.items = items
         self.next = next
         self.prev = prev
+        self.number = number
+        self.total_rows = total_rows
+        if total_rows is not None and per_page:
+            self.page_count = max(1, (total_rows + per_page - 1) // per_page)
 
 
 def _clone(results, **options):
@@ -286,7 +2160,51 @@ def _clone(results, **options):
     return ViewResults(results.view, newopts)
 
 
-def paginate(view, count, start=None):
+_RANGE_OPTIONS = ('key', 'keys', 'startkey', 'endkey', 'start_key', 'end_key')
+
+
+def _counting_queries(view):
+    """
+    This returns a list of the queries (which don't return any rows) needed
+    to count the rows in the view's key range with `_count_rows`, or `None`
+    if they can't be counted that way. If the view doesn't have a key range,
+    no queries are needed, because every query returns ``total_rows``.
+    """
+    options = view.options
+    if not any(name in options for name in _RANGE_OPTIONS):
+        return []
+    if ('keys' in options or 'start_key' in options or 'end_key' in options
+            or options.get('inclusive_end') is False):
+        return None
+    # the offset of the first row in the range
+    queries = [_clone(view, limit=0, skip=0)]
+    if 'key' in options or 'endkey' in options:
+        # going backwards from the end of the range, the offset is the
+        # number of rows after it
+        reverse = options.copy()
+        end = reverse.pop('key', None)
+        end = reverse.pop('endkey', end)
+        for name in ('startkey', 'startkey_docid', 'endkey_docid'):
+            reverse.pop(name, None)
+        reverse.update(limit=0, skip=0, startkey=end,
+                       descending=not options.get('descending', False))
+        if 'endkey_docid' in options:
+            reverse['startkey_docid'] = options['endkey_docid']
+        queries.append(ViewResults(view.view, reverse))
+    return queries
+
+
+def _count_rows(total_rows, queries):
+    """
+    This works out the number of rows in a key range from the results of the
+    `_counting_queries`.
+    """
+    if queries is None or total_rows is None:
+        return None
+    return max(0, total_rows - sum(query.offset for query in queries))
+
+
+def paginate(view, count, start=None, total=False, keys_only=False):
     """
     This implements linked-list pagination. You pass in the view to use, the
     number of items per page, and the JSON-encoded `start` value for the page,
@@ -296,63 +2214,252 @@ def paginate(view, count, start=None):
     navigation using next and previous links. However, it is also very fast
     and efficient.
     
+    For every page after the first, the query for the page itself and the
+    query that finds the start of the previous page are run concurrently, so
+    it only takes about as long as a single query.
+    
     You should probably use the `start` values as a query parameter (e.g.
     ``?start=whatever``).
     
+    The `Page` has its `~Page.total_rows` and `~Page.page_count` set if they
+    can be worked out for free, from the ``total_rows`` CouchDB sends with
+    every query (that is, when the view doesn't have a key range, and isn't
+    a reduce view). If `total` is `True`, it will also count the rows in a
+    key range, with one or two extra queries that don't return any rows and
+    are run at the same time as the others.
+    
+    If `keys_only` is `True`, only the rows on the page are fetched with
+    ``include_docs``. The row after the page and the rows before it are only
+    needed for their keys and IDs, so they are fetched without documents,
+    and a reduce view is queried with ``reduce=false``. This is meant for
+    views that emit `None` as the value: with those, only the documents that
+    are actually displayed are sent.
+    
     :param view: A `ViewResults` instance. (You get this by calling, slicing,
                  or subscripting a `ViewDefinition` or `ViewField`.)
     :param count: The number of items to put on a single page.
     :param start: The start value of the page, as a string.
+    :param total: Whether to count the rows in a key range.
+    :param keys_only: Whether to only get documents for the rows on the page.
     """
     # first, patch the wrapper
     if isinstance(view, OldViewDefinition):
         view = view()
-    old_wrapper = view.view.wrapper or (lambda r: r)
-    view.view.wrapper = Row
-    rewrap = lambda r: [old_wrapper(i) for i in r]
+    old_wrapper = view.view.wrapper
+    view.view.wrapper = _KeyedRow
+    rewrap = lambda rows: [row.wrap(old_wrapper) for row in rows]
+    
+    if keys_only:
+        # without reducing, so there are keys and IDs even for reduce views
+        view = _clone(view, reduce=False, include_docs=False)
+    counting = _counting_queries(view)
+    if counting and not total:
+        counting = None
     
     # then, actually paginate
     # the algorithm we're using is in the misc/pagination-algorithm.txt file
     if start is None:
         # first page
-        results = list(_clone(view, limit=count + 1))
-        if len(results) <= count:
-            # only one page
-            return Page(rewrap(results), None, None)
-        else:
-            nextstart = results[-1]
-            next = json.dumps([nextstart.key, nextstart.id])
-            return Page(rewrap(results[:-1]), next, None)
+        position = {}
     else:
         # subsequent page
-        descending = view.options.get('descending', False)
         try:
             startkey, startid = json.loads(start)
         except ValueError:
             abort(400)
-        forwards = list(_clone(view, limit=count + 1, startkey=startkey,
-                               startkey_docid=startid))
-        backwards = list(_clone(view, limit=count, startkey=startkey,
-                                startkey_docid=startid, skip=1,
-                                descending=not descending))
-        
-        # processing "next" link
-        if len(forwards) <= count:
-            # there isn't a next page
-            next = None
-            items = forwards
-        else:
-            # there is a next page
-            nextstart = forwards[-1]
-            next = json.dumps([nextstart.key, nextstart.id])
-            items = forwards[:-1]
-        
-        # processing "previous" link
-        if not backwards:
-            # no previous results
-            prev = None
+        position = dict(startkey=startkey, startkey_docid=startid)
+    
+    if keys_only:
+        # only the rows on the page need their documents - the start of the
+        # next page is found with a separate query for just its key and ID
+        queries = [_clone(view, limit=count, include_docs=True, **position),
+                   _clone(view, limit=1, skip=count, **position)]
+    else:
+        queries = [_clone(view, limit=count + 1, **position)]
+    if position:
+        descending = view.options.get('descending', False)
+        queries.append(_clone(view, limit=count, skip=1,
+                              descending=not descending, **position))
+    # the queries don't depend on each other, so run them at once
+    fetched = gather(*(queries + (counting or [])))
+    total_rows = _count_rows(fetched[0].total_rows, counting)
+    
+    # processing "next" link
+    if keys_only:
+        items, lookahead = fetched[0].rows, fetched[1].rows
+        nextstart = lookahead[0] if lookahead else None
+    else:
+        forwards = fetched[0].rows
+        items = forwards[:count]
+        nextstart = forwards[count] if len(forwards) > count else None
+    if nextstart is None:
+        # there isn't a next page
+        next = None
+    else:
+        next = json.dumps([nextstart.key, nextstart.id])
+    
+    # processing "previous" link
+    backwards = fetched[len(queries) - 1].rows if position else None
+    if not backwards:
+        # no previous results
+        prev = None
+    else:
+        prevstart = backwards[-1]
+        prev = json.dumps([prevstart.key, prevstart.id])
+    
+    return Page(rewrap(items), next, prev, total_rows=total_rows,
+                per_page=count)
+
+
+class _PageIndex(object):
+    """
+    This is the sparse index `paginate_numbered` keeps for a view: the key
+    and document ID of the first row of every page it has found so far, by
+    page number, and the first page number known not to exist.
+    """
+    def __init__(self, update_seq):
+        self.update_seq = update_seq
+        self.starts = {}
+        self.end = None
+        self.lock = threading.Lock()
+    
+    def add(self, number, row):
+        # `number` is the page `row` starts
+        if row is not None:
+            self.starts[number] = (row.key, row.id)
+        elif self.end is None or number < self.end:
+            self.end = number
+    
+    def nearest(self, number):
+        """
+        This returns the number and start of the closest page at or before
+        `number` that is in the index, or `None` if there isn't one.
+        """
+        found = [n for n in self.starts if n <= number]
+        if not found:
+            return None
+        return max(found), self.starts[max(found)]
+
+
+_page_indexes = collections.OrderedDict()
+_page_indexes_lock = threading.Lock()
+_MAX_PAGE_INDEXES = 100
+
+
+def _page_index(key, update_seq):
+    """
+    This returns the cached page index for `key`, or a new one if there isn't
+    one or the view has changed since it was built.
+    """
+    with _page_indexes_lock:
+        index = _page_indexes.pop(key, None)
+        if index is None or index.update_seq != update_seq:
+            index = _PageIndex(update_seq)
+        _page_indexes[key] = index
+        while len(_page_indexes) > _MAX_PAGE_INDEXES:
+            _page_indexes.popitem(last=False)
+    return index
+
+
+def paginate_numbered(view, count, number, total=False):
+    """
+    This implements numbered pagination, without the cost of using ``skip``
+    to get to a page. It keeps an index of the key and document ID every
+    page starts at, so every page can be fetched with ``startkey`` and
+    ``startkey_docid`` like in `paginate`. The index is only built as far as
+    the pages that are actually requested, it is cached (in memory, for the
+    whole process), and it is rebuilt whenever the view changes.
+    
+    Finding where a page starts for the first time takes one request, which
+    reads the keys (but not the documents) of the rows from the closest page
+    before it that is in the index, and adds every page it passes to the
+    index. Once a page is indexed, getting it takes one request to check
+    whether the view has changed and one to get the items.
+    
+    The `Page` it returns has its `number` set, and its `next` and `prev`
+    values are page numbers instead of start values. If there is no page
+    with the given number, a 404 error is raised.
+    
+    Its `~Page.total_rows` and `~Page.page_count` are set the same way as
+    with `paginate`. Since the query that checks whether the view has changed
+    starts where the view does, counting the rows in a key range only takes
+    one extra query at most. When the number of pages is known, asking for a
+    page past the end is a 404 right away.
+    
+    :param view: A `ViewResults` instance. (You get this by calling, slicing,
+                 or subscripting a `ViewDefinition` or `ViewField`.)
+    :param count: The number of items to put on a single page.
+    :param number: The number of the page, starting at 1.
+    :param total: Whether to count the rows in a key range.
+    """
+    if isinstance(view, OldViewDefinition):
+        view = view()
+    old_wrapper = view.view.wrapper
+    view.view.wrapper = _KeyedRow
+    rewrap = lambda rows: [row.wrap(old_wrapper) for row in rows]
+    if number < 1:
+        abort(404)
+    
+    options = dict((k, v) for k, v in view.options.iteritems()
+                   if k not in ('limit', 'skip'))
+    key = (view.view.resource.url, json.dumps(options, sort_keys=True), count)
+    # asking for no rows at all is a cheap way to see if the view changed,
+    # and its offset is where the view's key range starts
+    meta = _clone(view, limit=0, skip=0, update_seq=True)
+    counting = _counting_queries(view)
+    if counting and not total:
+        counting = None
+    if counting:
+        counting = gather(meta, *counting[1:])
+    total_rows = _count_rows(meta.total_rows, counting)
+    if total_rows is not None and number > 1 and \
+       (number - 1) * count >= total_rows:
+        abort(404)
+    index = _page_index(key, meta.update_seq)
+    
+    # the lock is never held during a request - if two threads extend the
+    # index at the same time, they'll just both find the same rows
+    with index.lock:
+        if number > 1 and index.end is not None and number >= index.end:
+            abort(404)
+        nearest = index.nearest(number)
+    if nearest is not None and nearest[0] == number:
+        start = nearest[1]
+    elif nearest is None and number == 1:
+        start = None
+    else:
+        # the rows up to the page are scanned without their documents, and
+        # every page boundary on the way is indexed
+        if nearest is None:
+            found, scan = 1, {}
         else:
-            prevstart = backwards[-1]
-            prev = json.dumps([prevstart.key, prevstart.id])
-        
-        return Page(rewrap(items), next, prev)
+            found, (startkey, startid) = nearest
+            scan = dict(startkey=startkey, startkey_docid=startid)
+        rows = _clone(view, include_docs=False,
+                      limit=(number - found) * count + 1, **scan).rows
+        with index.lock:
+            for page in xrange(found + 1, number + 1):
+                offset = (page - found) * count
+                if offset >= len(rows):
+                    index.add(page, None)
+                    break
+                index.add(page, rows[offset])
+        if len(rows) <= (number - found) * count:
+            abort(404)
+        row = rows[(number - found) * count]
+        start = (row.key, row.id)
+    if start is None:
+        results = _clone(view, limit=count + 1).rows
+    else:
+        results = _clone(view, limit=count + 1, startkey=start[0],
+                         startkey_docid=start[1]).rows
+    with index.lock:
+        index.add(number, results[0] if results else None)
+        index.add(number + 1, results[count] if len(results) > count else None)
+    
+    if not results and number > 1:
+        abort(404)
+    next = number + 1 if len(results) > count else None
+    prev = number - 1 if number > 1 else None
+    return Page(rewrap(results[:count]), next, prev, number,
+                total_rows=total_rows, per_page=count)
@@ -32,7 +32,7 @@ setup(
     platforms='any',
     install_requires=[
         'Flask',
-        'CouchDB>=0.7'
+        'CouchDB>=1.0'
     ],
     tests_require='nose',
     test_suite='nose.collector',
@@ -14,11 +14,14 @@ override these with the environment variables `FLASKEXT_COUCHDB_SERVER` and
 :license:   MIT/X11, see LICENSE for details
 """
 from __future__ import with_statement
+import logging
 import os
+import time
 import couchdb
 import flask
 import flaskext.couchdb
 from couchdb.http import ResourceNotFound
+from werkzeug.exceptions import NotFound
 from datetime import datetime
 
 SERVER = os.environ.get('FLASKEXT_COUCHDB_SERVER', 'http://localhost:5984/')
@@ -69,6 +72,12 @@ SAMPLE_POSTS = [
     BlogPost(title='N3', text='number 3', author='Steve Person', id='3')
 ]
 
+
+def fresh_sample_posts():
+    return [BlogPost(title=p.title, text=p.text, author=p.author, id=p.id)
+            for p in SAMPLE_POSTS]
+
+
 POSTS_FOR_PAGINATION = [
     BlogPost(title='N%d' % n, text='number %d' % n, author='Foo',
              id='%04d' % n) for n in range(1, 51)
@@ -97,7 +106,34 @@ class TestFlaskextCouchDB(object):
             self.app.preprocess_request()
             print dir(flask.g)
             assert hasattr(flask.g, 'couch')
-            assert isinstance(flask.g.couch, couchdb.Database)
+            assert isinstance(flask.g.couch._get_current_object(),
+                              couchdb.Database)
+    
+    def test_connection_reuse(self):
+        self.app.config['COUCHDB_POOL_SIZE'] = 3
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.setup(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            first = flask.g.couch._get_current_object()
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            assert flask.g.couch._get_current_object() is first
+            pool = flask.g.couch.resource.session.connection_pool
+            assert pool.size == 3
+    
+    def test_connection_per_process(self):
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.setup(self.app)
+        db = manager.connect_db(self.app)
+        getpid = os.getpid
+        os.getpid = lambda: getpid() + 1
+        try:
+            forked = manager.connect_db(self.app)
+        finally:
+            os.getpid = getpid
+        assert forked is not db
+        assert forked.resource.session is not db.resource.session
     
     def test_add_viewdef(self):
         manager = flaskext.couchdb.CouchDBManager()
@@ -116,6 +152,38 @@ class TestFlaskextCouchDB(object):
         assert viewdefs[0].name == 'all_posts'
         assert viewdefs[1].name == 'by_author'
         assert viewdefs[2].name == 'tagged'
+        assert manager.all_viewdefs() is manager.all_viewdefs()
+    
+    def test_add_document_inherited(self):
+        class Draft(BlogPost):
+            by_author = None
+            drafts = flaskext.couchdb.ViewField('blog', '''\
+            function (doc) {
+                if (doc.doc_type == 'draft') {
+                    emit(doc._id, doc);
+                };
+            }''')
+        
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.add_document(Draft)
+        viewdefs = manager.all_viewdefs()
+        assert isinstance(viewdefs, tuple)
+        assert sorted(vd.name for vd in viewdefs) == ['all_posts', 'drafts',
+                                                      'tagged']
+        assert Draft.all_posts in viewdefs
+    
+    def test_view_field(self):
+        viewdef = BlogPost.all_posts
+        assert isinstance(viewdef, flaskext.couchdb.ViewDefinition)
+        assert BlogPost.all_posts is viewdef
+        assert BlogPost().all_posts is viewdef
+        assert viewdef.wrapper == BlogPost._wrap_row
+        
+        class Draft(BlogPost):
+            pass
+        
+        assert Draft.all_posts is not viewdef
+        assert Draft.all_posts.wrapper == Draft._wrap_row
     
     def test_sync(self):
         manager = flaskext.couchdb.CouchDBManager()
@@ -129,6 +197,97 @@ class TestFlaskextCouchDB(object):
         designdoc = db['_design/blog']
         assert 'by_author' in designdoc['views']
     
+    def test_warm_views(self):
+        manager = flaskext.couchdb.CouchDBManager(warm_views=True)
+        manager.add_document(BlogPost)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        warmer = manager.view_warmer(self.app)
+        warmer.join()
+        assert warmer.error is None
+        assert warmer.deployed == ['_design/blog']
+        
+        manager.add_viewdef(flaskext.couchdb.ViewDefinition('blog', 'titles',
+            '''function (doc) { emit(doc.title, null); }'''))
+        manager.sync(self.app)
+        warmer = manager.view_warmer(self.app)
+        warmer.join()
+        assert warmer.error is None
+        db = manager.connect_db(self.app)
+        assert 'titles' in db['_design/blog']['views']
+        assert 'all_posts' in db['_design/blog']['views']
+        assert '_design/blog-new' not in db
+        
+        manager.sync(self.app)
+        assert manager.view_warmer(self.app) is warmer
+    
+    def test_warm_views_sync_once(self):
+        manager = flaskext.couchdb.CouchDBManager(warm_views=True,
+                                                  sync_once=True)
+        manager.add_document(BlogPost)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        # while it is warming, the sync doesn't have to be repeated
+        assert not manager.needs_sync(self.app)
+        warmer = manager.view_warmer(self.app)
+        warmer.join()
+        assert warmer.error is None
+        assert not manager.needs_sync(self.app)
+        
+        # the warmer fails, so the sync isn't recorded
+        manager.add_viewdef(flaskext.couchdb.ViewDefinition('blog', 'titles',
+            '''function (doc) { emit(doc.title, null); }'''))
+        saved = flaskext.couchdb.ViewWarmer._wait
+        def fail(self, doc):
+            raise RuntimeError('indexing failed')
+        flaskext.couchdb.ViewWarmer._wait = fail
+        try:
+            manager.sync(self.app)
+            warmer = manager.view_warmer(self.app)
+            warmer.join()
+        finally:
+            flaskext.couchdb.ViewWarmer._wait = saved
+        assert isinstance(warmer.error, RuntimeError)
+        assert manager.needs_sync(self.app)
+        
+        manager.sync(self.app)
+        warmer = manager.view_warmer(self.app)
+        warmer.join()
+        assert warmer.error is None
+        assert not manager.needs_sync(self.app)
+        db = manager.connect_db(self.app)
+        assert 'titles' in db['_design/blog']['views']
+    
+    def test_stale_views(self):
+        manager = flaskext.couchdb.CouchDBManager(stale_views='ok',
+                                                  refresh_interval=0.1)
+        manager.add_document(BlogPost)
+        fresh = flaskext.couchdb.ViewDefinition('tests', 'all', '''\
+            function(doc) {
+                emit(doc._id, null);
+            }''', stale=False)
+        manager.add_viewdef(fresh)
+        manager.setup(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.update(fresh_sample_posts())
+            assert BlogPost.all_posts().options['stale'] == 'ok'
+            assert BlogPost.all_posts(stale='update_after').options['stale'] \
+                   == 'update_after'
+            assert 'stale' not in fresh().options
+            
+            refresher = manager.view_refresher(self.app)
+            assert isinstance(refresher, flaskext.couchdb.ViewRefresher)
+            stored = time.time()
+            for n in range(50):
+                if refresher.refreshed.get('blog', 0) >= stored:
+                    break
+                time.sleep(0.1)
+            assert 0 <= refresher.staleness('blog') < 5
+            assert refresher.staleness() is not None
+            assert len(BlogPost.all_posts().rows) == 3
+            refresher.stop()
+    
     def test_documents(self):
         manager = flaskext.couchdb.CouchDBManager()
         manager.setup(self.app)
@@ -145,6 +304,180 @@ class TestFlaskextCouchDB(object):
             assert post.id == 'hello'
             assert post.title == 'Hello'
             assert post.doc_type == 'blogpost'
+            # the old argument order works with the proxy too
+            assert BlogPost.load(flask.g.couch, 'hello').title == 'Hello'
+            posts = BlogPost.load_many(flask.g.couch, ['hello'])
+            assert posts[0].title == 'Hello'
+    
+    def test_wrap(self):
+        defaults = []
+        
+        class Event(flaskext.couchdb.Document):
+            doc_type = 'event'
+            title = flaskext.couchdb.TextField()
+            created = flaskext.couchdb.DateTimeField(
+                default=lambda: defaults.append(1) or datetime.now())
+        
+        event = Event.wrap({'_id': 'e', 'doc_type': 'event', 'title': 'E'})
+        assert isinstance(event, Event)
+        assert (event.id, event.title) == ('e', 'E')
+        assert not defaults
+        
+        class CustomEvent(Event):
+            def __init__(self, *args, **kwargs):
+                Event.__init__(self, *args, **kwargs)
+                self.custom = True
+        
+        assert CustomEvent.wrap({'_id': 'c'}).custom
+    
+    def test_load_many(self):
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.setup(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.update(fresh_sample_posts())
+            posts = BlogPost.load_many(['3', 'missing', '1'], chunk_size=2)
+            assert len(posts) == 3
+            assert isinstance(posts[0], BlogPost)
+            assert posts[0].title == 'N3'
+            assert posts[1] is None
+            assert posts[2].id == '1'
+    
+    def test_store_many(self):
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.setup(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            posts = [BlogPost(title='N%d' % n, author='Foo', id='s%d' % n)
+                     for n in range(5)]
+            results = BlogPost.store_many(posts, batch_size=2)
+            assert len(results) == 5
+            assert all(r.ok for r in results)
+            assert all(post.rev is not None for post in posts)
+            assert results[0].rev == posts[0].rev
+            stale = BlogPost(title='Stale', author='Foo', id='s0')
+            results = BlogPost.store_many([stale, posts[1]])
+            assert results[0].conflict
+            assert stale.rev is None
+            assert results[1].ok
+    
+    def test_identity_map(self):
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.setup(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.update(fresh_sample_posts())
+            identity_map = flask.g.couch_identity_map
+            first = BlogPost.load('1')
+            assert BlogPost.load('1') is first
+            assert BlogPost.load_many(['2', '1'])[1] is first
+            assert identity_map.hits == 2
+            assert identity_map.misses == 2
+            twice = BlogPost.load_many(['3', '3'])
+            assert twice[0] is twice[1]
+            assert BlogPost.load('3') is twice[0]
+            first.store()
+            assert BlogPost.load('1') is not first
+            self.app.process_response(self.app.response_class())
+            assert len(identity_map) == 0
+    
+    def test_document_cache(self):
+        self.app.config['COUCHDB_DOCUMENT_CACHE_SIZE'] = 10
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.setup(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            cache = flask.g.couch.resource.session.cache
+            assert isinstance(cache, flaskext.couchdb.DocumentCache)
+            flask.g.couch.update(fresh_sample_posts())
+            assert BlogPost.load('1').title == 'N1'
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            post = BlogPost.load('1')
+            assert post.title == 'N1'
+            assert (cache.hits, cache.misses) == (1, 1)
+            post.title = 'Changed'
+            post.store()
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            assert BlogPost.load('1').title == 'Changed'
+            assert (cache.hits, cache.misses) == (1, 2)
+            assert BlogPost.load('missing') is None
+    
+    def test_own_writes_invalidate(self):
+        class Connected(object):
+            connected = True
+        
+        self.app.config['COUCHDB_DOCUMENT_CACHE_SIZE'] = 10
+        views = flaskext.couchdb.ViewCache(ttl=3600, check_update_seq=False)
+        titles = flaskext.couchdb.ViewDefinition('tests', 'titles', '''\
+            function (doc) {
+                emit(doc._id, doc.title);
+            }''', cache=views)
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.add_viewdef(titles)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        db = manager.connect_db(self.app)
+        db.update(fresh_sample_posts())
+        cache = db.resource.session.cache
+        # as if the changes feed were being followed
+        cache.listener = Connected()
+        
+        post = BlogPost.load('1', db)
+        assert BlogPost.load('1', db).title == 'N1'
+        assert titles(db)['1'].rows[0].value == 'N1'
+        post.title = 'Changed'
+        post.store(db)
+        assert BlogPost.load('1', db).title == 'Changed'
+        assert titles(db)['1'].rows[0].value == 'Changed'
+        
+        post.title = 'Again'
+        BlogPost.store_many([post], db)
+        assert BlogPost.load('1', db).title == 'Again'
+        assert titles(db)['1'].rows[0].value == 'Again'
+    
+    def test_async(self):
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.add_document(BlogPost)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            stored = [p.store_async() for p in fresh_sample_posts()]
+            assert all(isinstance(r.get(), BlogPost) for r in stored)
+            loading = BlogPost.load_async('2')
+            steve = BlogPost.by_author.call_async(key='Steve Person')
+            missing = BlogPost.load_async('missing')
+            assert loading.get().title == 'N2'
+            assert len(steve.get().rows) == 2
+            assert missing.get() is None
+            assert missing.ready()
+    
+    def test_gather(self):
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.add_document(BlogPost)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.update(fresh_sample_posts())
+            steve, everything, fred, answer = flaskext.couchdb.gather(
+                BlogPost.by_author['Steve Person'],
+                BlogPost.all_posts,
+                BlogPost.load_async('2'),
+                lambda: 42
+            )
+            assert len(steve.rows) == 2
+            assert len(everything.rows) == 3
+            assert fred.author == 'Fred Person'
+            assert answer == 42
+            try:
+                flaskext.couchdb.gather(lambda: 1, lambda: 1 / 0)
+            except ZeroDivisionError:
+                pass
+            else:
+                assert False, 'the exception was not raised'
     
     def test_loading_nonexistent(self):
         manager = flaskext.couchdb.CouchDBManager()
@@ -166,6 +499,24 @@ class TestFlaskextCouchDB(object):
             steve_res = BlogPost.by_author['Steve Person']
             assert all(r.author == 'Steve Person' for r in steve_res)
     
+    def test_multi_key_views(self):
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.add_document(BlogPost)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.update(fresh_sample_posts())
+            steve, nobody, fred, steve_again = BlogPost.by_author.multi(
+                ['Steve Person', 'Nobody', 'Fred Person', 'Steve Person'],
+                chunk_size=2
+            )
+            assert sorted(p.id for p in steve) == ['1', '3']
+            assert isinstance(steve[0], BlogPost)
+            assert nobody == []
+            assert [p.id for p in fred] == ['2']
+            assert [p.id for p in steve_again] == [p.id for p in steve]
+    
     def test_running_standalone_views(self):
         manager = flaskext.couchdb.CouchDBManager()
         viewdef = flaskext.couchdb.ViewDefinition('tests', 'active', '''\
@@ -190,6 +541,81 @@ class TestFlaskextCouchDB(object):
                 goal.remove(row.key)
             assert not goal
     
+    def test_view_cache(self):
+        cache = flaskext.couchdb.ViewCache()
+        manager = flaskext.couchdb.CouchDBManager()
+        viewdef = flaskext.couchdb.ViewDefinition('tests', 'active', '''\
+            function (doc) {
+                if (doc.active) {
+                    emit(doc.username, doc.fullname)
+                };
+            }''', cache=cache)
+        manager.add_viewdef(viewdef)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            for d in SAMPLE_DATA:
+                flask.g.couch.save(d.copy())
+            assert len(viewdef()) == 2
+            assert len(viewdef()) == 2
+            assert viewdef['fred'].rows[0].value == 'Fred Person'
+            assert (cache.hits, cache.misses) == (1, 2)
+            flask.g.couch.save(dict(username='al', fullname='Al Person',
+                                    active=True))
+            assert len(viewdef()) == 3
+            assert cache.misses == 3
+    
+    def test_view_cache_stale(self):
+        cache = flaskext.couchdb.ViewCache()
+        manager = flaskext.couchdb.CouchDBManager()
+        viewdef = flaskext.couchdb.ViewDefinition('tests', 'active', '''\
+            function (doc) {
+                if (doc.active) {
+                    emit(doc.username, doc.fullname)
+                };
+            }''', cache=cache, stale='ok')
+        manager.add_viewdef(viewdef)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            for d in SAMPLE_DATA:
+                flask.g.couch.save(d.copy())
+            flask.g.couch.view('tests/active', limit=0).rows
+            assert len(viewdef()) == 2
+            flask.g.couch.save(dict(username='al', fullname='Al Person',
+                                    active=True))
+            # the index hasn't seen the new document yet
+            assert len(viewdef()) == 2
+            assert (cache.hits, cache.misses) == (1, 1)
+            flask.g.couch.view('tests/active', limit=0).rows
+            assert len(viewdef()) == 3
+            assert cache.misses == 2
+    
+    def test_changes_listener(self):
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.sync(self.app)
+        db = manager.connect_db(self.app)
+        seen = []
+        listener = flaskext.couchdb.ChangesListener(db, seen.append,
+                                                    timeout=1)
+        listener.start()
+        try:
+            for n in range(50):
+                if listener.connected:
+                    break
+                time.sleep(0.1)
+            assert seen == [None]
+            db.save(dict(_id='changed'))
+            for n in range(50):
+                if len(seen) > 1:
+                    break
+                time.sleep(0.1)
+            assert seen[1] == ['changed']
+        finally:
+            listener.stop()
+    
     def test_autosync(self):
         track = []
         manager = flaskext.couchdb.CouchDBManager()
@@ -197,8 +623,22 @@ class TestFlaskextCouchDB(object):
         manager.setup(self.app)
         with self.app.test_request_context('/'):
             self.app.preprocess_request()
+            flask.g.couch.name
             assert 'synced' in track
     
+    def test_lazy_g_couch(self):
+        track = []
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.on_sync(lambda db: track.append('synced'))
+        manager.setup(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            assert not track
+            assert getattr(flask.g, '_couch_db', None) is None
+            self.app.process_response(self.app.response_class())
+            assert not hasattr(flask.g, 'couch')
+        assert not track
+    
     def test_manual_sync(self):
         track = []
         manager = flaskext.couchdb.CouchDBManager(auto_sync=False)
@@ -211,6 +651,26 @@ class TestFlaskextCouchDB(object):
             self.app.preprocess_request()
             assert 'synced' not in track
     
+    def test_sync_once(self):
+        track = []
+        manager = flaskext.couchdb.CouchDBManager(sync_once=True)
+        manager.on_sync(lambda db: track.append('synced'))
+        manager.setup(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.name
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.name
+        assert track == ['synced']
+        assert not manager.needs_sync(self.app)
+        manager.add_document(BlogPost)
+        assert manager.needs_sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            assert '_design/blog' in flask.g.couch
+        assert track == ['synced', 'synced']
+    
     def test_paging_all(self):
         paginate = flaskext.couchdb.paginate
         manager = flaskext.couchdb.CouchDBManager()
@@ -237,6 +697,229 @@ class TestFlaskextCouchDB(object):
             assert isinstance(page2.prev, basestring)
             assert isinstance(page2.prev, basestring)
             
+            page3 = paginate(BlogPost.all_posts(), 5, page2.next)
+            assert page3.items[0].id == '0011'
+            assert page3.prev == page1.next
+            
+    
+    def test_iter_rows(self):
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.add_document(BlogPost)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.update(POSTS_FOR_PAGINATION)
+            
+            posts = list(BlogPost.all_posts.iter_rows(batch_size=7))
+            assert len(posts) == 50
+            assert isinstance(posts[0], BlogPost)
+            assert [p.id for p in posts] == ['%04d' % n for n in range(1, 51)]
+            
+            posts = list(BlogPost.all_posts.iter_rows(batch_size=7, limit=10,
+                                                      descending=True))
+            assert [p.id for p in posts] == ['%04d' % n
+                                             for n in range(50, 40, -1)]
+    
+    def test_stream_view(self):
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.add_document(BlogPost)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        manager.connect_db(self.app).update(POSTS_FOR_PAGINATION)
+        
+        @self.app.route('/posts.json')
+        def posts_json():
+            return flaskext.couchdb.stream_view(BlogPost.all_posts,
+                                                batch_size=7)
+        
+        response = self.app.test_client().get('/posts.json')
+        assert response.mimetype == 'application/json'
+        rows = flask.json.loads(response.data)['rows']
+        assert len(rows) == 50
+        assert rows[0]['id'] == '0001'
+        assert rows[-1]['value']['title'] == 'N50'
+    
+    def test_request_stats(self):
+        manager = flaskext.couchdb.CouchDBManager(auto_sync=False)
+        manager.add_document(BlogPost)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        manager.connect_db(self.app).update(fresh_sample_posts())
+        self.app.config['COUCHDB_SERVER_TIMING'] = True
+        collected = []
+        manager.on_request_stats(collected.append)
+        
+        @self.app.route('/posts/<id>')
+        def show_post(id):
+            assert isinstance(flask.g.couch_stats,
+                              flaskext.couchdb.RequestStats)
+            post = BlogPost.load(id)
+            missing = BlogPost.load_async('missing')
+            steve = BlogPost.by_author(key='Steve Person').rows
+            assert missing.get() is None
+            return post.title
+        
+        response = self.app.test_client().get('/posts/1')
+        assert response.data == 'N1'
+        assert 'couchdb;dur=' in response.headers['Server-Timing']
+        stats, = collected
+        assert len(stats) == 3
+        statuses = sorted(call.status for call in stats.calls)
+        assert statuses == [200, 200, 404]
+        assert all(call.method == 'GET' for call in stats.calls)
+        assert any(call.path.endswith('/_view/by_author')
+                   for call in stats.calls)
+        assert stats.bytes_in > 0
+        assert stats.elapsed > 0
+    
+    def test_slow_query_log(self):
+        manager = flaskext.couchdb.CouchDBManager(auto_sync=False)
+        manager.add_document(BlogPost)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        self.app.config['COUCHDB_SLOW_QUERY_MS'] = 0
+        self.app.config['COUCHDB_QUERY_SAMPLE_RATE'] = 1.0
+        collected = []
+        manager.on_request_stats(collected.append)
+        messages = []
+        
+        class Handler(logging.Handler):
+            def emit(self, record):
+                messages.append(record.getMessage())
+        
+        handler = Handler()
+        logger = logging.getLogger('flaskext.couchdb')
+        logger.addHandler(handler)
+        
+        @self.app.route('/authors/<author>')
+        def show_author(author):
+            # the feed waits on purpose, so it isn't logged
+            flask.g.couch.changes(feed='longpoll', since=0, timeout=1)
+            return str(len(BlogPost.by_author(key=author).rows))
+        
+        try:
+            response = self.app.test_client().get('/authors/Steve')
+        finally:
+            logger.removeHandler(handler)
+        assert response.data == '0'
+        message, = messages
+        assert 'from endpoint show_author' in message
+        assert '_design/blog/_view/by_author?key=' in message
+        assert 'show_author' in message.split('\n', 1)[1]
+        stats, = collected
+        assert stats.endpoint == 'show_author'
+        assert stats.calls[0].stack is not None
+    
+    def test_paging_numbered(self):
+        paginate_numbered = flaskext.couchdb.paginate_numbered
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.add_document(BlogPost)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.update(POSTS_FOR_PAGINATION)
+            
+            page7 = paginate_numbered(BlogPost.all_posts(), 5, 7)
+            assert page7.number == 7
+            assert [p.id for p in page7.items] == ['0031', '0032', '0033',
+                                                   '0034', '0035']
+            assert isinstance(page7.items[0], BlogPost)
+            assert (page7.prev, page7.next) == (6, 8)
+            
+            page10 = paginate_numbered(BlogPost.all_posts(), 5, 10)
+            assert page10.items[-1].id == '0050'
+            assert page10.next is None
+            
+            page1 = paginate_numbered(BlogPost.all_posts(), 5, 1)
+            assert page1.items[0].id == '0001'
+            assert page1.prev is None
+            
+            try:
+                paginate_numbered(BlogPost.all_posts(), 5, 11)
+            except NotFound:
+                pass
+            else:
+                assert False, 'page 11 should not exist'
+            
+            BlogPost(title='N0', author='Foo', id='0000').store()
+            # the index is cold again, but that's still one query for the
+            # update_seq, one to find the page, and one for its items
+            calls = len(flask.g.couch_stats.calls)
+            page7 = paginate_numbered(BlogPost.all_posts(), 5, 7)
+            assert page7.items[0].id == '0030'
+            assert len(flask.g.couch_stats.calls) - calls == 3
+            # the pages before it were indexed on the way
+            calls = len(flask.g.couch_stats.calls)
+            page3 = paginate_numbered(BlogPost.all_posts(), 5, 3)
+            assert page3.items[0].id == '0010'
+            assert len(flask.g.couch_stats.calls) - calls == 2
+            page9 = paginate_numbered(BlogPost.all_posts(), 5, 9)
+            assert page9.items[0].id == '0040'
+            assert (page9.prev, page9.next) == (8, 10)
+    
+    def test_paging_totals(self):
+        paginate = flaskext.couchdb.paginate
+        paginate_numbered = flaskext.couchdb.paginate_numbered
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.add_document(BlogPost)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.update(POSTS_FOR_PAGINATION)
+            
+            page1 = paginate(BlogPost.all_posts(), 5)
+            assert (page1.total_rows, page1.page_count) == (50, 10)
+            page2 = paginate(BlogPost.all_posts(), 5, page1.next)
+            assert (page2.total_rows, page2.page_count) == (50, 10)
+            
+            ranged = BlogPost.all_posts(startkey='0011', endkey='0022')
+            assert paginate(ranged, 5).total_rows is None
+            page1 = paginate(ranged, 5, total=True)
+            assert (page1.total_rows, page1.page_count) == (12, 3)
+            page2 = paginate(BlogPost.all_posts(startkey='0011',
+                             endkey='0022'), 5, page1.next, total=True)
+            assert page2.total_rows == 12
+            
+            page3 = paginate_numbered(BlogPost.all_posts(startkey='0011',
+                                      endkey='0022'), 5, 3, total=True)
+            assert (page3.total_rows, page3.page_count) == (12, 3)
+            assert len(page3.items) == 2
+            
+            page = paginate(BlogPost.all_posts(key='0005'), 5, total=True)
+            assert page.total_rows == 1
+    
+    def test_paging_keys_only(self):
+        paginate = flaskext.couchdb.paginate
+        manager = flaskext.couchdb.CouchDBManager()
+        manager.add_document(BlogPost)
+        manager.setup(self.app)
+        manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.update(POSTS_FOR_PAGINATION)
+            
+            page1 = paginate(BlogPost.all_posts(), 5, keys_only=True)
+            assert [p.id for p in page1.items] == ['0001', '0002', '0003',
+                                                   '0004', '0005']
+            assert isinstance(page1.items[0], BlogPost)
+            assert page1.items[0].title == 'N1'
+            assert page1.prev is None
+            assert page1.next == paginate(BlogPost.all_posts(), 5).next
+            
+            page2 = paginate(BlogPost.all_posts(), 5, page1.next,
+                             keys_only=True)
+            assert page2.items[0].id == '0006'
+            page3 = paginate(BlogPost.all_posts(), 5, page2.next,
+                             keys_only=True)
+            assert page3.prev == page1.next
+            
+            last = paginate(BlogPost.all_posts(startkey='0046'), 5,
+                            keys_only=True)
+            assert len(last.items) == 5
+            assert last.next is None
     
     def test_paging_keys(self):
         pass